@@ -1,224 +1,676 @@
+import cProfile
+import io
+import itertools
 import os
 import random
+import re
 import json
-from flask import Flask, render_template, request, jsonify, send_from_directory
-from PIL import Image, ImageDraw
-import numpy as np
+import shutil
+import tempfile
+import threading
+import time
+import hashlib
+import uuid
+from collections import OrderedDict
+from flask import (Flask, Response, current_app, g, render_template, request, jsonify,
+                   send_from_directory)
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 
-app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['PIECES_FOLDER'] = os.path.join('static', 'pieces')
-
-# Create necessary directories if they don't exist
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['PIECES_FOLDER'], exist_ok=True)
-
-def create_jigsaw_mask(width, height, edge_size=20):
-    """Create a jigsaw-like mask for a puzzle piece"""
-    mask = Image.new('L', (width, height), 255)
-    draw = ImageDraw.Draw(mask)
-    
-    # Define the tab/blank pattern for each edge
-    edges = {
-        'top': random.choice([1, -1]),     # 1: tab, -1: blank
-        'right': random.choice([1, -1]),
-        'bottom': random.choice([1, -1]),
-        'left': random.choice([1, -1])
+from defaults import ATLAS_MAX_SIZE, PIECES_FOLDER
+from jobs import JobQueue, QueueFull
+from metrics import Registry
+from puzzle_cache import PuzzleCache, cache_key, image_digest
+from puzzle_zip import directory_entries, iter_zip
+
+# Pillow, NumPy and the modules built on them (slicer, edge_map, solver) are
+# imported where they are used, so starting a worker loads only Flask
+
+def create_app(config=None):
+    """Build the app with the settings below, overridden by config
+
+    Folders, the puzzle cache and the job queue are only set up when a
+    request first needs them (see services).
+    """
+    app = Flask(__name__)
+    app.config['UPLOAD_FOLDER'] = 'uploads'
+    app.config['PIECES_FOLDER'] = PIECES_FOLDER
+    app.config['ATLAS_MAX_SIZE'] = ATLAS_MAX_SIZE
+    # Finished puzzles kept under PIECES_FOLDER before the least recently used go
+    app.config['PUZZLE_CACHE_MAX_ENTRIES'] = 100
+    app.config['PUZZLE_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+    # Worker processes used to crop, mask and encode pieces (1 renders serially)
+    app.config['SLICE_WORKERS'] = 1
+    # Background threads running /upload jobs, and how many may be in flight
+    app.config['JOB_WORKERS'] = 2
+    app.config['JOB_MAX_PENDING'] = 32
+    # Uploads are downscaled to at most this many pixels a side before slicing
+    app.config['MAX_PUZZLE_SIZE'] = 4096
+    # Uploads of at least this many megapixels (after downscaling) are sliced
+    # one row of pieces at a time, keeping a single band in RGBA
+    app.config['STREAM_MIN_MEGAPIXELS'] = 8
+    # Largest grid accepted, in pieces; 100 x 100 is the largest index.html offers
+    app.config['MAX_PIECES'] = 100 * 100
+    # Keep a copy of every uploaded original under UPLOAD_FOLDER
+    app.config['KEEP_UPLOADS'] = False
+    # Bytes of decoded source bands of lazy puzzles kept in memory for
+    # rendering their pieces (one band per piece row and pyramid level)
+    app.config['LAZY_SOURCE_CACHE_BYTES'] = 256 * 1024 * 1024
+    # Pyramid puzzles keep up to this many pixels a side at full detail, halving
+    # per level until pieces would drop below PYRAMID_MIN_PIECE_SIZE
+    app.config['PYRAMID_MAX_SIZE'] = 16384
+    app.config['PYRAMID_MIN_PIECE_SIZE'] = 32
+    # Pyramid sources of more pixels are refused as possible decompression
+    # bombs; Pillow's own limit, which stays in force for everything else, is
+    # about 179 megapixels
+    app.config['PYRAMID_MAX_SOURCE_PIXELS'] = 2 * 16384 * 16384
+    # Edge compatibility matrices kept in memory for /hint, and the largest
+    # puzzle they are built for (two n x n float32 matrices: 2500 pieces, 50 MB)
+    app.config['HINT_CACHE'] = 4
+    app.config['HINT_MAX_PIECES'] = 2500
+    # Piece encoding: 'png', 'png8' (palette-quantized PNG) or 'webp' with alpha
+    app.config['PIECE_FORMAT'] = 'png'
+    app.config['PNG_COMPRESS_LEVEL'] = 6
+    app.config['WEBP_QUALITY'] = 90
+    # Pieces under a puzzle id never change, so browsers may keep them for good
+    app.config['PIECE_MAX_AGE'] = 365 * 24 * 60 * 60
+    # cProfile every request (and its slicing job), or only those sent with an
+    # "X-Profile: 1" header; stats are written to PROFILE_FOLDER
+    app.config['PROFILE_REQUESTS'] = False
+    app.config['PROFILE_HEADER_ENABLED'] = False
+    app.config['PROFILE_FOLDER'] = 'profiles'
+    if config:
+        app.config.update(config)
+    # Everything the app keeps in memory is its own, so apps built side by
+    # side never share metrics or memoized sources and matrices
+    app.extensions['jigsaw'] = {
+        'lock': threading.Lock(),
+        'metrics': AppMetrics(),
+        # Row bands of lazy sources, least recently used first, and their bytes
+        'lazy_bands': OrderedDict(),
+        'lazy_bands_bytes': 0,
+        'lazy_bands_lock': threading.Lock(),
+        # One lock per (puzzle, level) being cut into bands, so a slow decode
+        # only holds up requests for that same source
+        'lazy_source_locks': {},
+        'compatibility': OrderedDict(),
+        'compatibility_lock': threading.Lock()
     }
     
-    # Draw the edges
-    for edge, direction in edges.items():
-        if edge == 'top' and direction == 1:
-            # Draw a tab on top edge
-            draw.ellipse((width//2 - edge_size, -edge_size, 
-                         width//2 + edge_size, edge_size), fill=0)
-        elif edge == 'top' and direction == -1:
-            # Draw a blank on top edge
-            draw.ellipse((width//2 - edge_size, -edge_size, 
-                         width//2 + edge_size, edge_size), fill=255)
-            
-        if edge == 'right' and direction == 1:
-            # Draw a tab on right edge
-            draw.ellipse((width - edge_size, height//2 - edge_size, 
-                         width + edge_size, height//2 + edge_size), fill=0)
-        elif edge == 'right' and direction == -1:
-            # Draw a blank on right edge
-            draw.ellipse((width - edge_size, height//2 - edge_size, 
-                         width + edge_size, height//2 + edge_size), fill=255)
-            
-        if edge == 'bottom' and direction == 1:
-            # Draw a tab on bottom edge
-            draw.ellipse((width//2 - edge_size, height - edge_size, 
-                         width//2 + edge_size, height + edge_size), fill=0)
-        elif edge == 'bottom' and direction == -1:
-            # Draw a blank on bottom edge
-            draw.ellipse((width//2 - edge_size, height - edge_size, 
-                         width//2 + edge_size, height + edge_size), fill=255)
-            
-        if edge == 'left' and direction == 1:
-            # Draw a tab on left edge
-            draw.ellipse((-edge_size, height//2 - edge_size, 
-                         edge_size, height//2 + edge_size), fill=0)
-        elif edge == 'left' and direction == -1:
-            # Draw a blank on left edge
-            draw.ellipse((-edge_size, height//2 - edge_size, 
-                         edge_size, height//2 + edge_size), fill=255)
-    
-    return mask, edges
-
-def split_image(image_path, rows, cols, piece_shape):
-    """Split an image into puzzle pieces"""
-    # Load and convert image to RGBA
-    img = Image.open(image_path).convert('RGBA')
-    
-    # Calculate piece dimensions
-    piece_width = img.width // cols
-    piece_height = img.height // rows
-    
-    pieces_info = []
-    
-    # Create a dictionary to store edge information
-    edge_map = {}
-    
-    # First pass: create edge patterns for all pieces
-    for row in range(rows):
-        for col in range(cols):
-            piece_id = f"{row}_{col}"
-            edge_map[piece_id] = {
-                'top': None,
-                'right': None,
-                'bottom': None,
-                'left': None
-            }
-    
-    # Second pass: assign edge patterns ensuring they match adjacent pieces
-    for row in range(rows):
-        for col in range(cols):
-            piece_id = f"{row}_{col}"
-            
-            # Top edge
-            if row > 0:
-                # Match with the bottom edge of the piece above
-                edge_map[piece_id]['top'] = -edge_map[f"{row-1}_{col}"]['bottom']
-            else:
-                # Top row pieces have flat top edges
-                edge_map[piece_id]['top'] = 0
-                
-            # Left edge
-            if col > 0:
-                # Match with the right edge of the piece to the left
-                edge_map[piece_id]['left'] = -edge_map[f"{row}_{col-1}"]['right']
-            else:
-                # Leftmost pieces have flat left edges
-                edge_map[piece_id]['left'] = 0
-                
-            # For bottom and right edges of pieces not on the border, randomly assign
-            if row < rows - 1:
-                edge_map[piece_id]['bottom'] = random.choice([1, -1])
-            else:
-                # Bottom row pieces have flat bottom edges
-                edge_map[piece_id]['bottom'] = 0
-                
-            if col < cols - 1:
-                edge_map[piece_id]['right'] = random.choice([1, -1])
-            else:
-                # Rightmost pieces have flat right edges
-                edge_map[piece_id]['right'] = 0
-    
-    # Third pass: create and save the pieces
-    for row in range(rows):
-        for col in range(cols):
-            # Calculate piece position
-            left = col * piece_width
-            upper = row * piece_height
-            right = left + piece_width
-            lower = upper + piece_height
-            
-            # Crop the piece from the original image
-            piece = img.crop((left, upper, right, lower))
-            
-            piece_id = f"{row}_{col}"
-            piece_filename = f"piece_{row}_{col}.png"
-            piece_path = os.path.join(app.config['PIECES_FOLDER'], piece_filename)
-            
-            if piece_shape == 'jigsaw':
-                # Create a base mask for the piece (fully opaque)
-                mask = Image.new('L', (piece_width, piece_height), 255)
-                draw = ImageDraw.Draw(mask)
-                
-                # Apply edge patterns
-                edge_size = min(piece_width, piece_height) // 5
-                
-                # Top edge
-                if edge_map[piece_id]['top'] == 1:
-                    # Tab on top
-                    draw.ellipse((piece_width//2 - edge_size, -edge_size, 
-                                 piece_width//2 + edge_size, edge_size), fill=0)
-                elif edge_map[piece_id]['top'] == -1:
-                    # Blank on top
-                    draw.ellipse((piece_width//2 - edge_size, -edge_size, 
-                                 piece_width//2 + edge_size, edge_size), fill=255)
-                
-                # Right edge
-                if edge_map[piece_id]['right'] == 1:
-                    # Tab on right
-                    draw.ellipse((piece_width - edge_size, piece_height//2 - edge_size, 
-                                 piece_width + edge_size, piece_height//2 + edge_size), fill=0)
-                elif edge_map[piece_id]['right'] == -1:
-                    # Blank on right
-                    draw.ellipse((piece_width - edge_size, piece_height//2 - edge_size, 
-                                 piece_width + edge_size, piece_height//2 + edge_size), fill=255)
-                
-                # Bottom edge
-                if edge_map[piece_id]['bottom'] == 1:
-                    # Tab on bottom
-                    draw.ellipse((piece_width//2 - edge_size, piece_height - edge_size, 
-                                 piece_width//2 + edge_size, piece_height + edge_size), fill=0)
-                elif edge_map[piece_id]['bottom'] == -1:
-                    # Blank on bottom
-                    draw.ellipse((piece_width//2 - edge_size, piece_height - edge_size, 
-                                 piece_width//2 + edge_size, piece_height + edge_size), fill=255)
-                
-                # Left edge
-                if edge_map[piece_id]['left'] == 1:
-                    # Tab on left
-                    draw.ellipse((-edge_size, piece_height//2 - edge_size, 
-                                 edge_size, piece_height//2 + edge_size), fill=0)
-                elif edge_map[piece_id]['left'] == -1:
-                    # Blank on left
-                    draw.ellipse((-edge_size, piece_height//2 - edge_size, 
-                                 edge_size, piece_height//2 + edge_size), fill=255)
-                
-                # Apply the mask to the piece
-                piece.putalpha(mask)
-            
-            # Save the piece
-            piece.save(piece_path)
-            
-            # Store piece information
-            pieces_info.append({
-                'id': piece_id,
-                'row': row,
-                'col': col,
-                'filename': piece_filename,
-                'width': piece_width,
-                'height': piece_height,
-                'correctX': left,
-                'correctY': upper
-            })
-    
-    # Shuffle the pieces for initial random placement
-    random.shuffle(pieces_info)
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(stop_abandoned_profiler)
+    app.add_url_rule('/', view_func=index)
+    app.add_url_rule('/upload', view_func=upload_file, methods=['POST'])
+    app.add_url_rule('/jobs/<job_id>', view_func=job_status)
+    app.add_url_rule('/metrics', view_func=metrics_endpoint)
+    app.add_url_rule('/cache/stats', view_func=cache_stats)
+    app.add_url_rule('/hint', view_func=hint, methods=['POST'])
+    app.add_url_rule('/puzzles/<puzzle_id>.zip', view_func=download_puzzle)
+    app.add_url_rule('/static/pieces/<filename>', view_func=serve_piece)
+    app.add_url_rule('/static/pieces/<puzzle_id>/<filename>', view_func=serve_piece)
+    return app
+
+# Files a lazy puzzle keeps next to its pieces
+LAZY_SOURCE_FILENAME = 'source'
+LAZY_SPEC_FILENAME = 'render.json'
+LAZY_BANDS_DIRNAME = 'bands'
+# Level 0 pieces keep the plain name; coarser pyramid levels add _lod<level>
+LAZY_PIECE_PATTERN = re.compile(r'piece_(\d+)_(\d+)(?:_lod(\d+))?\.(png|webp)')
+
+class AppMetrics:
+    """The metrics one app exports on /metrics, in a registry of its own"""
+
+    def __init__(self):
+        registry = self.registry = Registry()
+        self.http_request_seconds = registry.histogram(
+            'jigsaw_http_request_seconds', 'Time spent handling HTTP requests',
+            ['endpoint', 'status'])
+        self.uploads = registry.counter(
+            'jigsaw_uploads_total', 'Uploads by how they were answered', ['outcome'])
+        self.upload_bytes = registry.counter(
+            'jigsaw_upload_bytes_total', 'Bytes of uploaded images')
+        self.job_seconds = registry.histogram(
+            'jigsaw_job_seconds', 'Time a slicing job takes from decode to cached puzzle',
+            ['output'])
+        self.split_stage_seconds = registry.histogram(
+            'jigsaw_split_stage_seconds', 'Time split_image spends in each stage', ['stage'])
+        self.pieces_produced = registry.counter(
+            'jigsaw_pieces_produced_total', 'Pieces cut by split_image', ['shape'])
+        self.piece_bytes_written = registry.counter(
+            'jigsaw_piece_bytes_written_total', 'Bytes of piece and atlas files written',
+            ['format'])
+        self.image_megapixels = registry.histogram(
+            'jigsaw_image_megapixels', 'Size of the grid areas split_image slices',
+            buckets=(0.25, 0.5, 1, 2, 4, 8, 16, 32, 64))
+        self.lazy_pieces_rendered = registry.counter(
+            'jigsaw_lazy_pieces_rendered_total', 'Pieces rendered on first request', ['level'])
+        self.cache_entries = registry.gauge('jigsaw_cache_entries', 'Puzzles held by the puzzle cache')
+        self.cache_bytes = registry.gauge('jigsaw_cache_bytes', 'Bytes held by the puzzle cache')
+        self.cache_hits = registry.counter('jigsaw_cache_hits_total', 'Puzzle cache hits')
+        self.cache_misses = registry.counter('jigsaw_cache_misses_total', 'Puzzle cache misses')
+        self.cache_evictions = registry.counter('jigsaw_cache_evictions_total',
+                                                'Puzzles evicted from the cache')
+        self.jobs_pending = registry.gauge('jigsaw_jobs_pending', 'Slicing jobs queued or running')
+        self.hint_matrix_seconds = registry.histogram(
+            'jigsaw_hint_matrix_seconds',
+            'Time to build the edge compatibility matrices of a puzzle')
+
+def app_metrics():
+    return current_app.extensions['jigsaw']['metrics']
+
+def __getattr__(name):
+    # The slicing engine used to live in this module; its names still
+    # resolve here to the slicer's own objects, importing slicer only when
+    # first asked for. The app's wrappers around them go by other names
+    # (configured_encoding, split_with_metrics) so they never shadow these.
+    if not name.startswith('__'):
+        import slicer
+        if hasattr(slicer, name):
+            return getattr(slicer, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def services():
+    """The current app's puzzle cache and job queue, created on first use
+
+    This is also when the upload and piece folders are made, so importing
+    the module or calling create_app() leaves the disk alone.
+    """
+    state = current_app.extensions['jigsaw']
+    with state['lock']:
+        if 'puzzle_cache' not in state:
+            config = current_app.config
+            os.makedirs(config['UPLOAD_FOLDER'], exist_ok=True)
+            os.makedirs(config['PIECES_FOLDER'], exist_ok=True)
+            state['puzzle_cache'] = PuzzleCache(config['PIECES_FOLDER'],
+                                                config['PUZZLE_CACHE_MAX_ENTRIES'],
+                                                config['PUZZLE_CACHE_MAX_BYTES'])
+            state['job_queue'] = JobQueue(config['JOB_WORKERS'], config['JOB_MAX_PENDING'])
+        return state
+
+def get_puzzle_cache():
+    return services()['puzzle_cache']
+
+def get_job_queue():
+    return services()['job_queue']
+
+def in_app_context(flask_app, func, *args):
+    """Run func(*args) inside flask_app's context; job threads start without one"""
+    with flask_app.app_context():
+        return func(*args)
+
+def configured_encoding(piece_format=None):
+    """slicer.piece_encoding with the app's PNG and WebP settings"""
+    from slicer import piece_encoding
+    
+    config = current_app.config
+    return piece_encoding(piece_format or config['PIECE_FORMAT'],
+                          config['PNG_COMPRESS_LEVEL'], config['WEBP_QUALITY'])
+
+def split_with_metrics(image, rows, cols, piece_shape, output='files',
+                       output_dir=None, seed=None, workers=None, encoding=None, timings=None,
+                       edge_map=None, stream=False):
+    """slicer.split_image with the app's settings, recording its metrics
+
+    output_dir, workers and encoding default to PIECES_FOLDER, SLICE_WORKERS
+    and the PIECE_FORMAT settings.
+    """
+    import slicer
+    
+    config = current_app.config
+    if output_dir is None:
+        output_dir = config['PIECES_FOLDER']
+    if workers is None:
+        workers = config['SLICE_WORKERS']
+    if encoding is None:
+        encoding = configured_encoding()
+    if timings is None:
+        timings = {}
     
+    pieces_info, piece_width, piece_height = slicer.split_image(
+        image, rows, cols, piece_shape, output, output_dir, seed, workers, encoding, timings,
+        edge_map, config['ATLAS_MAX_SIZE'], stream)
+    
+    metrics = app_metrics()
+    for stage, seconds in timings.items():
+        metrics.split_stage_seconds.observe(seconds, stage=stage)
+    # split_image cuts anything but jigsaw square; labelling it so keeps the
+    # number of series fixed whatever a caller passes
+    metrics.pieces_produced.inc(len(pieces_info),
+                                shape='jigsaw' if piece_shape == 'jigsaw' else 'square')
+    metrics.image_megapixels.observe(cols * piece_width * rows * piece_height / 1e6)
+    written = {piece.get('atlas') or piece['filename'] for piece in pieces_info}
+    metrics.piece_bytes_written.inc(sum(os.path.getsize(os.path.join(output_dir, name))
+                                        for name in written),
+                                    format=encoding['format'])
     return pieces_info, piece_width, piece_height
 
-@app.route('/')
+
+# cProfile allows one active profiler per process, whichever app started it,
+# so this lock is shared by every app; concurrent profiling requests beyond
+# the first simply run unprofiled
+_profile_lock = threading.Lock()
+
+def profiling_requested():
+    return current_app.config['PROFILE_REQUESTS'] or (
+        current_app.config['PROFILE_HEADER_ENABLED'] and request.headers.get('X-Profile') == '1')
+
+def save_profile(profiler, name):
+    """Write profiler stats to PROFILE_FOLDER and return the file name"""
+    os.makedirs(current_app.config['PROFILE_FOLDER'], exist_ok=True)
+    filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}.prof"
+    profiler.dump_stats(os.path.join(current_app.config['PROFILE_FOLDER'], filename))
+    return filename
+
+def run_profiled(name, func, *args):
+    """Run func under cProfile when no other profile is running"""
+    # Wait briefly: a profiled upload request still holds the profiler while
+    # its job starts
+    if not _profile_lock.acquire(timeout=10):
+        return func(*args)
+    profiler = cProfile.Profile()
+    try:
+        result = profiler.runcall(func, *args)
+    finally:
+        _profile_lock.release()
+    filename = save_profile(profiler, name)
+    return dict(result, profile=filename) if isinstance(result, dict) else result
+
+def start_request():
+    g.request_started = time.perf_counter()
+    if profiling_requested() and _profile_lock.acquire(blocking=False):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+def finish_request(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _profile_lock.release()
+        response.headers['X-Profile-File'] = save_profile(profiler, request.endpoint or 'request')
+    app_metrics().http_request_seconds.observe(time.perf_counter() - g.request_started,
+                                               endpoint=request.endpoint or 'unknown',
+                                               status=response.status_code)
+    return response
+
+def stop_abandoned_profiler(exc):
+    # after_request is skipped when a view raises; never leave the lock held
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _profile_lock.release()
+
 def index():
     return render_template('index.html')
 
-@app.route('/upload', methods=['POST'])
+def build_puzzle(image_bytes, key, rows, cols, piece_shape, output, seed, encoding):
+    """Slice an uploaded image into the cache entry for key
+
+    Runs on the job queue and returns the job result (see job_response).
+    The upload is decoded once, straight from memory, and large ones are
+    sliced in streaming mode.
+    """
+    from edge_map import EdgeMap, tab_padding
+    from slicer import open_image, puzzle_payload
+    
+    started = time.perf_counter()
+    
+    # Build into a scratch directory the cache adopts once it is complete
+    build_dir = tempfile.mkdtemp(prefix=f'.{key}-', dir=current_app.config['PIECES_FOLDER'])
+    
+    try:
+        # Kept in its decoded mode; split_image makes it RGBA, whole or by band
+        img = open_image(io.BytesIO(image_bytes), current_app.config['MAX_PUZZLE_SIZE'])
+        app_metrics().split_stage_seconds.observe(time.perf_counter() - started, stage='decode')
+        stream = img.width * img.height >= current_app.config['STREAM_MIN_MEGAPIXELS'] * 1e6
+        
+        edge_map = EdgeMap.generate(rows, cols, seed)
+        pieces_info, piece_width, piece_height = split_with_metrics(
+            img, rows, cols, piece_shape, output, build_dir, seed, encoding=encoding,
+            edge_map=edge_map, stream=stream)
+        
+        jigsaw = piece_shape == 'jigsaw'
+        padding = tab_padding(piece_width, piece_height) if jigsaw and output == 'vector' else 0
+        payload = puzzle_payload(key, seed, pieces_info, img.size,
+                                 piece_width, piece_height, rows, cols,
+                                 edge_map.encode() if jigsaw else None, padding)
+        get_puzzle_cache().put(key, build_dir, payload)
+    except Exception:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+    
+    app_metrics().job_seconds.observe(time.perf_counter() - started, output=output)
+    return {'puzzleId': key, 'cached': False}
+
+def pyramid_levels(image_size, rows, cols, max_size, min_piece_size):
+    """Image and piece size of every level, halving from full detail
+
+    Each level's image is what load_image makes of the source for its
+    maxSize, so rendering a level needs nothing but that number.
+    """
+    from slicer import fit_size
+    
+    levels = []
+    while True:
+        level_max = max(1, max_size >> len(levels))
+        size = fit_size(image_size, level_max)
+        piece_width, piece_height = size[0] // cols, size[1] // rows
+        if levels and min(piece_width, piece_height) < min_piece_size:
+            break
+        levels.append({
+            'level': len(levels),
+            'maxSize': level_max,
+            'pieceWidth': piece_width,
+            'pieceHeight': piece_height
+        })
+        if level_max == 1:
+            break
+    return levels
+
+def prepare_lazy_puzzle(image_bytes, key, rows, cols, piece_shape, seed, encoding,
+                        pyramid=False):
+    """Plan a puzzle whose pieces are only rendered when first requested
+
+    Only the image header is read here: the edge map and piece geometry are
+    worked out from the seed and stored in render.json next to the original
+    bytes, which serve_piece decodes on the first piece request.
+    
+    A pyramid puzzle keeps up to PYRAMID_MAX_SIZE pixels and can render every
+    piece at several levels of detail, each half the size of the one before.
+    piece_3_4.png is full detail and piece_3_4_lod2.png a quarter of it.
+    """
+    from PIL import Image
+    
+    from edge_map import EdgeMap
+    from slicer import file_extension, fit_size, open_bounded, piece_info, puzzle_payload
+    
+    if pyramid:
+        max_size = current_app.config['PYRAMID_MAX_SIZE']
+        original_size = open_bounded(io.BytesIO(image_bytes),
+                                     current_app.config['PYRAMID_MAX_SOURCE_PIXELS']).size
+        image_size = fit_size(original_size, max_size)
+        levels = pyramid_levels(original_size, rows, cols, max(image_size),
+                                current_app.config['PYRAMID_MIN_PIECE_SIZE'])
+    else:
+        max_size = current_app.config['MAX_PUZZLE_SIZE']
+        image_size = fit_size(Image.open(io.BytesIO(image_bytes)).size, max_size)
+        levels = [{
+            'level': 0,
+            'maxSize': max_size,
+            'pieceWidth': image_size[0] // cols,
+            'pieceHeight': image_size[1] // rows
+        }]
+    piece_width = levels[0]['pieceWidth']
+    piece_height = levels[0]['pieceHeight']
+    
+    # Draw from the seed exactly as split_image does, so lazily rendered
+    # pieces match the ones an eager upload would have produced
+    edge_map = EdgeMap.generate(rows, cols, seed)
+    pieces_info = [piece_info(row, col, piece_width, piece_height, file_extension(encoding))
+                   for row in range(rows) for col in range(cols)]
+    random.Random(seed).shuffle(pieces_info)
+    
+    build_dir = tempfile.mkdtemp(prefix=f'.{key}-', dir=current_app.config['PIECES_FOLDER'])
+    try:
+        with open(os.path.join(build_dir, LAZY_SOURCE_FILENAME), 'wb') as f:
+            f.write(image_bytes)
+        with open(os.path.join(build_dir, LAZY_SPEC_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump({
+                'levels': levels,
+                'pieceShape': piece_shape,
+                'encoding': encoding,
+                'rows': rows,
+                'cols': cols,
+                'edges': edge_map.encode()
+            }, f)
+        client_levels = [{name: level[name] for name in ('level', 'pieceWidth', 'pieceHeight')}
+                         for level in levels]
+        payload = puzzle_payload(key, seed, pieces_info, image_size,
+                                 piece_width, piece_height, rows, cols,
+                                 edge_map.encode() if piece_shape == 'jigsaw' else None,
+                                 levels=client_levels if pyramid else None)
+        get_puzzle_cache().put(key, build_dir, payload)
+    except Exception:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+    
+    return {'puzzleId': key, 'cached': False}
+
+def load_lazy_spec(puzzle_id):
+    """Render spec of a lazy puzzle with its decoded edge map
+
+    Returns None if the puzzle was not created in lazy mode.
+    """
+    from edge_map import EdgeMap
+    
+    spec_path = os.path.join(get_puzzle_cache().path(puzzle_id), LAZY_SPEC_FILENAME)
+    if not os.path.isfile(spec_path):
+        return None
+    with open(spec_path, encoding='utf-8') as f:
+        spec = json.load(f)
+    spec['edgeMap'] = EdgeMap.decode(spec['rows'], spec['cols'], spec['edges'])
+    return spec
+
+def band_path(puzzle_id, level, row):
+    return os.path.join(get_puzzle_cache().path(puzzle_id), LAZY_BANDS_DIRNAME,
+                        f"{level}_{row}.png")
+
+def cut_lazy_bands(puzzle_id, spec, level):
+    """Decode a lazy source at one level and store it as one band per piece row
+
+    The source is decoded once in its own mode and each band is made RGBA
+    on its own, so a level never exists whole in RGBA. Bands count towards
+    the cache budget like the pieces rendered from them.
+    """
+    from slicer import open_image
+    
+    geometry = spec['levels'][level]
+    width = spec['cols'] * geometry['pieceWidth']
+    directory = get_puzzle_cache().path(puzzle_id)
+    os.makedirs(os.path.join(directory, LAZY_BANDS_DIRNAME), exist_ok=True)
+    # The upload was already held to Pillow's limit or, for pyramids, this one
+    img = open_image(os.path.join(directory, LAZY_SOURCE_FILENAME), geometry['maxSize'],
+                     current_app.config['PYRAMID_MAX_SOURCE_PIXELS'])
+    nbytes = 0
+    for row in range(spec['rows']):
+        path = band_path(puzzle_id, level, row)
+        if os.path.exists(path):
+            continue
+        upper = row * geometry['pieceHeight']
+        band = img.crop((0, upper, width, upper + geometry['pieceHeight'])).convert('RGBA')
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        band.save(temp_path, 'PNG', compress_level=1)
+        nbytes += os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+    get_puzzle_cache().grow(puzzle_id, nbytes)
+
+def load_lazy_band(puzzle_id, spec, level, row):
+    """One row of pieces of a lazy source at one level, as RGBA
+
+    The first request for a level cuts all its bands under a lock per puzzle
+    and level, so a burst of first piece requests shares one decode without
+    blocking other puzzles; JPEG sources are decoded straight at the reduced
+    scale of coarse levels. Decoded bands are memoized up to
+    LAZY_SOURCE_CACHE_BYTES.
+    """
+    from PIL import Image
+    
+    state = current_app.extensions['jigsaw']
+    bands, lock = state['lazy_bands'], state['lazy_bands_lock']
+    memo_key = (puzzle_id, level, row)
+    with lock:
+        if memo_key in bands:
+            bands.move_to_end(memo_key)
+            return bands[memo_key]
+    
+    path = band_path(puzzle_id, level, row)
+    if not os.path.exists(path):
+        cut_locks = state['lazy_source_locks']
+        with lock:
+            cut_lock = cut_locks.setdefault((puzzle_id, level), threading.Lock())
+        with cut_lock:
+            try:
+                if not os.path.exists(path):
+                    cut_lazy_bands(puzzle_id, spec, level)
+            finally:
+                with lock:
+                    cut_locks.pop((puzzle_id, level), None)
+    
+    with Image.open(path) as img:
+        band = img.convert('RGBA')
+    with lock:
+        if memo_key not in bands:
+            bands[memo_key] = band
+            state['lazy_bands_bytes'] += band.width * band.height * 4
+        while state['lazy_bands_bytes'] > current_app.config['LAZY_SOURCE_CACHE_BYTES'] and bands:
+            _, evicted = bands.popitem(last=False)
+            state['lazy_bands_bytes'] -= evicted.width * evicted.height * 4
+    return band
+
+def render_lazy_piece(puzzle_id, filename):
+    """Render a piece of a lazy puzzle to disk on its first request"""
+    from slicer import file_extension, render_piece, save_image
+    
+    match = LAZY_PIECE_PATTERN.fullmatch(filename)
+    # Level 0 has no suffix and levels are written without leading zeros, so
+    # every piece has exactly one name
+    if match is None or (match.group(3) or '').startswith('0'):
+        return
+    level = int(match.group(3) or 0)
+    spec = load_lazy_spec(puzzle_id)
+    if spec is None or level >= len(spec['levels']):
+        return
+    if match.group(4) != file_extension(spec['encoding']):
+        return
+    row, col = int(match.group(1)), int(match.group(2))
+    edge_map = spec['edgeMap']
+    if row >= edge_map.rows or col >= edge_map.cols:
+        return
+    
+    geometry = spec['levels'][level]
+    band = load_lazy_band(puzzle_id, spec, level, row)
+    piece = render_piece(band, 0, col, geometry['pieceWidth'], geometry['pieceHeight'],
+                         spec['pieceShape'], edge_map.piece(row, col))
+    
+    # Write under a private name first so a concurrent request never sends a
+    # half-written file
+    puzzle_cache = get_puzzle_cache()
+    piece_path = os.path.join(puzzle_cache.path(puzzle_id), filename)
+    temp_path = f"{piece_path}.{uuid.uuid4().hex}.tmp"
+    save_image(piece, temp_path, spec['encoding'])
+    rendered_first = not os.path.exists(piece_path)
+    nbytes = os.path.getsize(temp_path)
+    os.replace(temp_path, piece_path)
+    # Rendered pieces count towards the cache budget like eagerly cut ones
+    if rendered_first:
+        puzzle_cache.grow(puzzle_id, nbytes)
+    app_metrics().lazy_pieces_rendered.inc(level=level)
+
+def piece_images(puzzle_id, payload):
+    """Yield (index, image) for every piece of a cached puzzle, as RGBA
+
+    index is the piece's position in the payload. Lazy puzzles are cut from
+    their source bands in memory, row by row, instead of rendering every
+    piece to disk, so their pieces do not come in payload order.
+    """
+    from PIL import Image
+    
+    from slicer import render_piece
+    
+    spec = load_lazy_spec(puzzle_id)
+    if spec is not None:
+        geometry = spec['levels'][0]
+        by_row = sorted(range(len(payload['pieces'])),
+                        key=lambda index: payload['pieces'][index]['row'])
+        for index in by_row:
+            piece = payload['pieces'][index]
+            band = load_lazy_band(puzzle_id, spec, 0, piece['row'])
+            yield index, render_piece(band, 0, piece['col'], geometry['pieceWidth'],
+                                      geometry['pieceHeight'], spec['pieceShape'],
+                                      spec['edgeMap'].piece(piece['row'], piece['col']))
+        return
+    
+    directory = get_puzzle_cache().path(puzzle_id)
+    pages = {}
+    for index, piece in enumerate(payload['pieces']):
+        if 'atlas' in piece:
+            if piece['atlas'] not in pages:
+                pages[piece['atlas']] = Image.open(os.path.join(directory, piece['atlas'])).convert('RGBA')
+            left, upper = piece['atlasX'], piece['atlasY']
+            yield index, pages[piece['atlas']].crop((left, upper, left + piece['width'],
+                                                     upper + piece['height']))
+        else:
+            with Image.open(os.path.join(directory, piece['filename'])) as img:
+                yield index, img.convert('RGBA')
+
+def load_compatibility(puzzle_id, payload):
+    """Edge compatibility of a cached puzzle's pieces, memoized per puzzle
+
+    Only the outer two pixel lines of each side are kept while the pieces
+    stream past, in batches, so memory is bounded by the matrices.
+    """
+    import numpy as np
+    
+    from solver import Compatibility, piece_strips
+    
+    state = current_app.extensions['jigsaw']
+    memo = state['compatibility']
+    with state['compatibility_lock']:
+        if puzzle_id in memo:
+            memo.move_to_end(puzzle_id)
+            return memo[puzzle_id]
+        
+        started = time.perf_counter()
+        strips = {}
+        batch = []
+        order = []
+        for item in itertools.chain(piece_images(puzzle_id, payload), [None]):
+            if item is not None:
+                order.append(item[0])
+                batch.append(np.asarray(item[1]))
+            if batch and (item is None or len(batch) == 256):
+                for side, values in piece_strips(np.stack(batch)).items():
+                    strips.setdefault(side, []).append(values)
+                batch = []
+        # Back to payload order, which is how /hint numbers the pieces
+        positions = np.argsort(order)
+        compatibility = Compatibility.from_strips(
+            {side: np.concatenate(values)[positions] for side, values in strips.items()})
+        app_metrics().hint_matrix_seconds.observe(time.perf_counter() - started)
+        
+        memo[puzzle_id] = compatibility
+        while len(memo) > current_app.config['HINT_CACHE']:
+            memo.popitem(last=False)
+        return compatibility
+
+def job_response(job_id, job):
+    """JSON body describing a job for /upload and /jobs/<job_id>
+
+    A finished job only remembers its puzzle id (and whether it was a cache
+    hit); the payload, several MB for a large vector puzzle, is read back
+    from the cache on every poll instead of being held by the queue.
+    """
+    body = {
+        'jobId': job_id,
+        'status': job['status'],
+        'statusUrl': f"/jobs/{job_id}"
+    }
+    if job['status'] == 'done':
+        payload = get_puzzle_cache().payload(job['result']['puzzleId'])
+        if payload is None:
+            body['status'] = 'failed'
+            body['error'] = 'The puzzle is no longer cached, please upload it again'
+        else:
+            body['result'] = dict(payload, **job['result'])
+    elif job['status'] == 'failed':
+        body['error'] = job['error']
+    return body
+
 def upload_file():
+    from PIL import Image
+    
+    from slicer import PIECE_FORMATS, PIECE_SHAPES, fit_size, open_bounded
+    
     if 'image' not in request.files:
         return jsonify({'error': 'No image part'}), 400
     
@@ -227,39 +679,211 @@ def upload_file():
         return jsonify({'error': 'No selected file'}), 400
     
     # Get parameters
-    rows = int(request.form.get('rows', 4))
-    cols = int(request.form.get('cols', 4))
+    try:
+        rows = int(request.form.get('rows', 4))
+        cols = int(request.form.get('cols', 4))
+        seed = request.form.get('seed')
+        seed = int(seed) if seed is not None else None
+    except ValueError:
+        return jsonify({'error': 'rows, cols and seed must be integers'}), 400
+    if rows < 1 or cols < 1:
+        return jsonify({'error': 'rows and cols must be at least 1'}), 400
+    max_pieces = current_app.config['MAX_PIECES']
+    if rows * cols > max_pieces:
+        return jsonify({'error': f"A puzzle has at most {max_pieces} pieces"}), 400
     piece_shape = request.form.get('piece_shape', 'jigsaw')
+    # The shape is part of the cache key, so only real shapes may reach it
+    if piece_shape not in PIECE_SHAPES:
+        return jsonify({'error': 'Unknown piece shape'}), 400
+    output = request.form.get('output', 'files')
+    if output not in ('files', 'atlas', 'lazy', 'pyramid', 'vector'):
+        return jsonify({'error': 'Unknown output mode'}), 400
+    piece_format = request.form.get('format', current_app.config['PIECE_FORMAT'])
+    if piece_format not in PIECE_FORMATS:
+        return jsonify({'error': 'Unknown piece format'}), 400
+    encoding = configured_encoding(piece_format)
+    
+    metrics = app_metrics()
+    image_bytes = file.read()
+    metrics.upload_bytes.inc(len(image_bytes))
+    puzzle_cache, job_queue = get_puzzle_cache(), get_job_queue()
     
-    # Save the uploaded file
-    filename = secure_filename(file.filename)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(file_path)
+    # Optionally keep the original, in a directory of its own so concurrent
+    # uploads with the same filename cannot clobber each other
+    if current_app.config['KEEP_UPLOADS']:
+        filename = secure_filename(file.filename) or 'image'
+        upload_dir = tempfile.mkdtemp(dir=current_app.config['UPLOAD_FOLDER'])
+        with open(os.path.join(upload_dir, filename), 'wb') as f:
+            f.write(image_bytes)
     
-    # Process the image
+    # Puzzles are keyed on the image content, the grid and the edge map seed.
+    # Without an explicit seed one is derived from the image, so uploading
+    # the same image again hits the cache.
+    digest = image_digest(image_bytes)
+    if seed is None:
+        seed = int(digest[:8], 16)
+    max_size = current_app.config['PYRAMID_MAX_SIZE' if output == 'pyramid' else 'MAX_PUZZLE_SIZE']
+    
+    # Only the header is read: every piece must keep at least one pixel, or
+    # the puzzle could never be cut
     try:
-        pieces_info, piece_width, piece_height = split_image(file_path, rows, cols, piece_shape)
-        
-        # Get the original image dimensions
-        img = Image.open(file_path)
-        img_width, img_height = img.size
-        
-        return jsonify({
-            'success': True,
-            'pieces': pieces_info,
-            'imageWidth': img_width,
-            'imageHeight': img_height,
-            'pieceWidth': piece_width,
-            'pieceHeight': piece_height,
-            'rows': rows,
-            'cols': cols
-        })
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        if output == 'pyramid':
+            header = open_bounded(io.BytesIO(image_bytes),
+                                  current_app.config['PYRAMID_MAX_SOURCE_PIXELS'])
+        else:
+            header = Image.open(io.BytesIO(image_bytes))
+        width, height = fit_size(header.size, max_size)
+    except Image.DecompressionBombError:
+        return jsonify({'error': 'Image is too large'}), 400
+    except Exception:
+        return jsonify({'error': 'Unreadable image'}), 400
+    if width // cols < 1 or height // rows < 1:
+        return jsonify({'error': 'Too many rows or columns for the size of this image'}), 400
+    
+    key = cache_key(digest, rows=rows, cols=cols, piece_shape=piece_shape,
+                    output=output, seed=seed, max_size=max_size, encoding=encoding)
+    
+    if puzzle_cache.get(key) is not None:
+        metrics.uploads.inc(outcome='cached')
+        job_id = job_queue.add_finished({'puzzleId': key, 'cached': True}, key)
+        return jsonify(job_response(job_id, job_queue.get(job_id)))
+    
+    # Lazy and pyramid puzzles need no slicing up front, so they skip the queue
+    if output in ('lazy', 'pyramid'):
+        try:
+            result = prepare_lazy_puzzle(image_bytes, key, rows, cols, piece_shape, seed,
+                                         encoding, pyramid=output == 'pyramid')
+        except Exception as e:
+            metrics.uploads.inc(outcome='error')
+            return jsonify({'error': str(e)}), 400
+        metrics.uploads.inc(outcome=output)
+        job_id = job_queue.add_finished(result, key)
+        return jsonify(job_response(job_id, job_queue.get(job_id)))
+    
+    # A profiled upload also profiles the slicing job on the worker thread
+    job_args = (build_puzzle, image_bytes, key, rows, cols, piece_shape, output, seed, encoding)
+    if profiling_requested():
+        job_args = (run_profiled, f"job-{key}") + job_args
+    
+    try:
+        job_id = job_queue.submit(in_app_context, current_app._get_current_object(), *job_args,
+                                  key=key)
+    except QueueFull:
+        metrics.uploads.inc(outcome='rejected')
+        response = jsonify({'error': 'Too many puzzles are being created, please retry'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    
+    metrics.uploads.inc(outcome='queued')
+    return jsonify(job_response(job_id, job_queue.get(job_id))), 202
+
+def job_status(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job_response(job_id, job))
+
+def metrics_endpoint():
+    metrics = app_metrics()
+    cache = get_puzzle_cache().stats()
+    metrics.cache_entries.set(cache['entries'])
+    metrics.cache_bytes.set(cache['bytes'])
+    # The cache keeps its own running totals; scrapes copy them over
+    metrics.cache_hits.set_total(cache['hits'])
+    metrics.cache_misses.set_total(cache['misses'])
+    metrics.cache_evictions.set_total(cache['evictions'])
+    metrics.jobs_pending.set(get_job_queue().stats()['pending'])
+    return Response(metrics.registry.render(), content_type=metrics.registry.content_type)
+
+def cache_stats():
+    return jsonify(dict(get_puzzle_cache().stats(), jobs=get_job_queue().stats()))
+
+def hint():
+    """Suggest two pieces that fit together, judged from their edge pixels
+
+    The body names the puzzle and, as lists of piece ids, the groups the
+    player has already joined; those pairs are never suggested. With
+    "solve": true the whole grid is assembled as well.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        body = {}
+    groups = body.get('groups', [])
+    if not isinstance(groups, list) or not all(
+            isinstance(group, list) and all(isinstance(piece_id, str) for piece_id in group)
+            for group in groups):
+        return jsonify({'error': 'groups must be a list of lists of piece ids'}), 400
+    puzzle_id = body.get('puzzleId')
+    payload = get_puzzle_cache().get(puzzle_id) if isinstance(puzzle_id, str) else None
+    if payload is None:
+        return jsonify({'error': 'Unknown puzzle'}), 404
+    if len(payload['pieces']) > current_app.config['HINT_MAX_PIECES']:
+        return jsonify({'error': 'Too many pieces for hints'}), 400
+    
+    compatibility = load_compatibility(puzzle_id, payload)
+    ids = [piece['id'] for piece in payload['pieces']]
+    index = {piece_id: i for i, piece_id in enumerate(ids)}
+    group_of = list(range(len(ids)))
+    for number, group in enumerate(groups):
+        for piece_id in group:
+            if piece_id in index:
+                group_of[index[piece_id]] = len(ids) + number
+    
+    result = {'hint': None}
+    found = compatibility.hint(group_of)
+    if found is not None:
+        confidence, i, j, direction = found
+        result['hint'] = {
+            'piece': ids[i],
+            'neighbour': ids[j],
+            'side': 'right' if direction == 'right' else 'bottom',
+            'confidence': confidence
+        }
+    if body.get('solve'):
+        placement = compatibility.solve(payload['rows'], payload['cols'])
+        result['placement'] = [[ids[i] for i in row] for row in placement]
+    return jsonify(result)
+
+def download_puzzle(puzzle_id):
+    # Only cache entries can be downloaded, which also keeps the id from
+    # naming any other directory
+    puzzle_cache = get_puzzle_cache()
+    if puzzle_cache.get(puzzle_id) is None:
+        return jsonify({'error': 'Unknown puzzle'}), 404
+
+    # Streamed in chunks with the pieces stored as they are, so a large
+    # puzzle costs neither memory nor recompression
+    entries = directory_entries(puzzle_cache.path(puzzle_id), puzzle_id)
+    response = Response(iter_zip(entries), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{puzzle_id}.zip"'
+    return response
+
+def serve_piece(filename, puzzle_id=None):
+    # Flask resolves relative directories against the app root, but pieces
+    # are written relative to the working directory
+    pieces_root = os.path.abspath(current_app.config['PIECES_FOLDER'])
+    
+    if puzzle_id is None:
+        # Loose files written by the CLI may be overwritten, so revalidate
+        response = send_from_directory(pieces_root, filename)
+        response.cache_control.no_cache = True
+        return response
+    
+    piece_path = safe_join(current_app.config['PIECES_FOLDER'], puzzle_id, filename)
+    if piece_path is not None and not os.path.exists(piece_path):
+        render_lazy_piece(puzzle_id, filename)
+    
+    # The puzzle id hashes the image and every setting that shapes its
+    # pieces, so a URL under it always names the same bytes. That makes the
+    # id and filename a strong ETag and lets browsers cache for good.
+    etag = hashlib.sha1(f"{puzzle_id}/{filename}".encode('utf-8')).hexdigest()
+    response = send_from_directory(pieces_root, f"{puzzle_id}/{filename}",
+                                   etag=etag, max_age=current_app.config['PIECE_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
-@app.route('/static/pieces/<filename>')
-def serve_piece(filename):
-    return send_from_directory(app.config['PIECES_FOLDER'], filename)
+app = create_app()
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,92 @@
+"""Benchmark main.py --batch across batch processes and rendering workers
+
+A directory of synthetic images is cut once per --jobs/--workers pair, each
+run a fresh `main.py --batch` process into an empty output directory.
+Reported per pair: wall time, puzzles and pieces per second. A run that
+does not exit within --timeout counts as hung (the batch workers must shut
+their rendering pools down to exit), and any failed run makes the script
+exit non-zero, so it doubles as a smoke test of the batch path.
+
+    python benchmarks/bench_batch.py --images 4 --jobs 1 2 --workers 1 2
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import REPO_ROOT, synthetic_image
+
+
+def run_batch(image_dir, grid, jobs, workers, timeout):
+    out_dir = tempfile.mkdtemp(prefix='jigsaw-bench-batch-')
+    command = [sys.executable, os.path.join(REPO_ROOT, 'main.py'), '--batch', image_dir,
+               '--out', out_dir, '--rows', str(grid), '--cols', str(grid),
+               '--jobs', str(jobs), '--workers', str(workers)]
+    start = time.perf_counter()
+    # A session of its own, so a hung run can be killed with every worker
+    # and fork server it started
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        return {'jobs': jobs, 'workers': workers, 'status': 'hung', 'wall_s': timeout}
+    wall = time.perf_counter() - start
+    puzzles = len([name for name in os.listdir(out_dir) if not name.startswith('.')])
+    return {
+        'jobs': jobs,
+        'workers': workers,
+        'status': 'ok' if process.returncode == 0 else f"exit {process.returncode}",
+        'wall_s': wall,
+        'puzzles': puzzles,
+        'puzzles_per_s': puzzles / wall,
+        'pieces_per_s': puzzles * grid * grid / wall
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=4, help='images in the batch')
+    parser.add_argument('--size', default='1600x1200', help='synthetic image size WxH')
+    parser.add_argument('--grid', type=int, default=10, help='rows and columns per puzzle')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='seconds before a run counts as hung (default 300)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    width, height = map(int, args.size.split('x'))
+    image_dir = tempfile.mkdtemp(prefix='jigsaw-bench-images-')
+    for index in range(args.images):
+        synthetic_image(width, height, seed=index).save(
+            os.path.join(image_dir, f"{index}.jpg"), quality=90)
+
+    print(f"{'jobs':>5} {'workers':>8} {'status':>8} {'wall s':>8} {'puzzles/s':>10} "
+          f"{'pieces/s':>9}")
+    results = []
+    for jobs in args.jobs:
+        for workers in args.workers:
+            result = run_batch(image_dir, args.grid, jobs, workers, args.timeout)
+            results.append(result)
+            print(f"{jobs:>5} {workers:>8} {result['status']:>8} {result['wall_s']:>8.2f} "
+                  f"{result.get('puzzles_per_s', 0):>10.2f} {result.get('pieces_per_s', 0):>9.0f}",
+                  flush=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'images': args.images, 'size': args.size, 'grid': args.grid,
+                       'results': results}, f, indent=2)
+
+    if any(result['status'] != 'ok' for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
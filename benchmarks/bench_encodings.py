@@ -0,0 +1,82 @@
+"""Compare piece encodings by bytes on disk and serving latency
+
+For each grid size and encoding the synthetic image is sliced through
+split_image, every piece is fetched once through serve_piece, and then again
+with If-None-Match to measure the conditional (304) path browsers take once
+pieces are cached.
+
+    python benchmarks/bench_encodings.py --size 2048x1536 --grids 4 10 20 40
+"""
+import argparse
+import os
+import time
+
+from common import import_app_in_scratch_dir, synthetic_image
+
+
+def fetch_all(client, urls, headers=None):
+    """Fetch every URL; returns (total seconds, total body bytes, responses)"""
+    start = time.perf_counter()
+    responses = [client.get(url, headers=headers or {}) for url in urls]
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(len(r.data) for r in responses), responses
+
+
+def run(app_module, img, grid, piece_format):
+    app = app_module.app
+    puzzle_id = f"bench-{grid}-{piece_format}"
+    output_dir = os.path.join(app.config['PIECES_FOLDER'], puzzle_id)
+    os.makedirs(output_dir, exist_ok=True)
+
+    with app.app_context():
+        encoding = app_module.configured_encoding(piece_format)
+        start = time.perf_counter()
+        pieces, _, _ = app_module.split_with_metrics(img, grid, grid, 'jigsaw', 'files', output_dir,
+                                                     seed=1, encoding=encoding)
+        slice_seconds = time.perf_counter() - start
+
+    client = app.test_client()
+    urls = [f"/static/pieces/{puzzle_id}/{piece['filename']}" for piece in pieces]
+    cold_seconds, body_bytes, responses = fetch_all(client, urls)
+    # Revalidate every piece the way a browser with a warm cache would
+    warm_seconds = 0.0
+    for url, response in zip(urls, responses):
+        start = time.perf_counter()
+        revalidated = client.get(url, headers={'If-None-Match': response.headers['ETag']})
+        warm_seconds += time.perf_counter() - start
+        assert revalidated.status_code == 304
+
+    return {
+        'grid': f"{grid}x{grid}",
+        'format': piece_format,
+        'bytes': body_bytes,
+        'slice_ms': slice_seconds * 1000,
+        'fetch_ms': cold_seconds * 1000,
+        'revalidate_ms': warm_seconds * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', default='2048x1536', help='synthetic image size WxH')
+    parser.add_argument('--grids', type=int, nargs='+', default=[4, 10, 20, 40])
+    args = parser.parse_args()
+
+    width, height = map(int, args.size.split('x'))
+    img = synthetic_image(width, height)
+    app_module = import_app_in_scratch_dir()
+
+    print(f"{'grid':>7} {'format':>6} {'bytes':>12} {'vs png':>7} "
+          f"{'slice ms':>9} {'fetch ms':>9} {'304 ms':>8}")
+    for grid in args.grids:
+        baseline = None
+        for piece_format in app_module.PIECE_FORMATS:
+            result = run(app_module, img, grid, piece_format)
+            baseline = baseline or result['bytes']
+            print(f"{result['grid']:>7} {result['format']:>6} {result['bytes']:>12,} "
+                  f"{result['bytes'] / baseline:>6.0%} {result['slice_ms']:>9.1f} "
+                  f"{result['fetch_ms']:>9.1f} {result['revalidate_ms']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Benchmark the edge compatibility matrices and solver against piece count
+
+For each grid the synthetic image is cut into square cells, shuffled, and
+the two compatibility matrices are built from them. Reported per grid: the
+build time, the matrices' size and the peak memory traced while building
+them, the solve time, and the share of pieces the solver put in the right
+cell and next to the right neighbour. Small grids also time a pair-by-pair
+Python loop for comparison.
+
+    python benchmarks/bench_solver.py --grids 10 20 30 40 50 --output solver.json
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+from common import synthetic_image
+
+from solver import Compatibility, piece_strips, side_features
+
+
+def cut_cells(img, grid):
+    pixels = np.asarray(img.convert('RGBA'))
+    height, width = pixels.shape[0] // grid, pixels.shape[1] // grid
+    return np.stack([pixels[row * height:(row + 1) * height, col * width:(col + 1) * width]
+                     for row in range(grid) for col in range(grid)])
+
+
+def loop_dissimilarity(a, wa, b, wb):
+    """The same matrix as solver.dissimilarity, one pair at a time"""
+    count = len(a)
+    result = np.full((count, count), np.inf, dtype=np.float32)
+    for i in range(count):
+        for j in range(count):
+            if i != j:
+                weights = wa[i] * wb[j]
+                result[i, j] = (weights * (a[i] - b[j]) ** 2).sum() / weights.sum()
+    return result
+
+
+def run(img, grid, loop_limit):
+    cells = cut_cells(img, grid)
+    order = np.random.default_rng(0).permutation(len(cells))
+    shuffled = cells[order]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    compatibility = Compatibility.from_cells(shuffled)
+    build_seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    placement = compatibility.solve(grid, grid)
+    solve_seconds = time.perf_counter() - start
+    # order maps shuffled positions back to the cell each piece came from
+    truth = order[placement]
+    expected = np.arange(grid * grid).reshape(grid, grid)
+    neighbours = np.concatenate([(truth[:, 1:] - truth[:, :-1] == 1).ravel(),
+                                 (truth[1:] - truth[:-1] == grid).ravel()])
+
+    result = {
+        'grid': f"{grid}x{grid}",
+        'pieces': grid * grid,
+        'build_ms': build_seconds * 1000,
+        'matrix_bytes': compatibility.right.nbytes + compatibility.down.nbytes,
+        'peak_traced_bytes': peak,
+        'solve_ms': solve_seconds * 1000,
+        'direct_accuracy': float((truth == expected).mean()),
+        'neighbour_accuracy': float(neighbours.mean()),
+        'loop_ms': None
+    }
+    if grid * grid <= loop_limit:
+        strips = piece_strips(shuffled)
+        start = time.perf_counter()
+        loop_dissimilarity(*side_features(strips['right']), *side_features(strips['left']))
+        # The loop covers one of the two matrices
+        result['loop_ms'] = (time.perf_counter() - start) * 2000
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', default='2000x2000', help='synthetic image size WxH')
+    parser.add_argument('--grids', type=int, nargs='+', default=[10, 20, 30, 40, 50])
+    parser.add_argument('--loop-limit', type=int, default=400,
+                        help='largest piece count to also time the Python loop for')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    width, height = map(int, args.size.split('x'))
+    img = synthetic_image(width, height)
+
+    print(f"{'grid':>7} {'pieces':>7} {'build ms':>9} {'loop ms':>9} {'matrix MB':>10} "
+          f"{'peak MB':>8} {'solve ms':>9} {'direct':>7} {'nbr':>6}")
+    results = []
+    for grid in args.grids:
+        result = run(img, grid, args.loop_limit)
+        results.append(result)
+        loop = f"{result['loop_ms']:.0f}" if result['loop_ms'] is not None else '-'
+        print(f"{result['grid']:>7} {result['pieces']:>7} {result['build_ms']:>9.1f} {loop:>9} "
+              f"{result['matrix_bytes'] / 2 ** 20:>10.1f} {result['peak_traced_bytes'] / 2 ** 20:>8.1f} "
+              f"{result['solve_ms']:>9.1f} {result['direct_accuracy']:>7.0%} "
+              f"{result['neighbour_accuracy']:>6.0%}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'size': args.size, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
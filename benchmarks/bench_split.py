@@ -0,0 +1,213 @@
+"""Benchmark split_image and /upload across image sizes, grids and shapes
+
+Every case runs in a fresh interpreter so its peak RSS is its own. The
+stream target runs split_image in streaming mode, to compare its peak RSS
+with the split target on large images. Results are written as JSON; pass
+an earlier file to --compare to flag regressions.
+
+    python benchmarks/bench_split.py --output before.json
+    python benchmarks/bench_split.py --output after.json --compare before.json
+    python benchmarks/bench_split.py --sizes 12000x5000 --grids 10 --targets split stream
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+from common import import_app_in_scratch_dir, synthetic_image
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_SIZES = ['1024x768', '2048x1536', '4096x3072']
+DEFAULT_GRIDS = [4, 10, 20, 50]
+DEFAULT_SHAPES = ['square', 'jigsaw']
+DEFAULT_TARGETS = ['split', 'stream', 'upload']
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process, or None where unsupported
+
+    On Linux ru_maxrss survives exec, so a case would report the parent's
+    peak (it builds the test images) whenever that is higher; VmHWM belongs
+    to the process's own memory map.
+    """
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+
+def run_split(app_module, image_path, grid, shape, stream=False):
+    app = app_module.app
+    os.makedirs(app.config['PIECES_FOLDER'], exist_ok=True)
+    output_dir = tempfile.mkdtemp(dir=app.config['PIECES_FOLDER'])
+    timings = {}
+    start = time.perf_counter()
+    with app.app_context():
+        app_module.split_with_metrics(image_path, grid, grid, shape, 'files', output_dir,
+                                      seed=1, timings=timings, stream=stream)
+    wall = time.perf_counter() - start
+    return wall, timings, directory_bytes(output_dir)
+
+
+def run_stream(app_module, image_path, grid, shape):
+    return run_split(app_module, image_path, grid, shape, stream=True)
+
+
+def run_upload(app_module, image_path, grid, shape):
+    client = app_module.app.test_client()
+    with open(image_path, 'rb') as f:
+        image_bytes = f.read()
+
+    start = time.perf_counter()
+    response = client.post('/upload', data={
+        'image': (BytesIO(image_bytes), os.path.basename(image_path)),
+        'rows': str(grid),
+        'cols': str(grid),
+        'piece_shape': shape,
+        'seed': '1'
+    })
+    accepted = time.perf_counter() - start
+    job = response.get_json()
+    while job['status'] not in ('done', 'failed'):
+        time.sleep(0.005)
+        job = client.get(job['statusUrl']).get_json()
+    wall = time.perf_counter() - start
+    if job['status'] == 'failed':
+        raise RuntimeError(job['error'])
+
+    with app_module.app.app_context():
+        puzzle_dir = app_module.get_puzzle_cache().path(job['result']['puzzleId'])
+    timings = {'accept': accepted, 'job': wall - accepted}
+    return wall, timings, directory_bytes(puzzle_dir)
+
+
+def run_case(case):
+    """Run one case in this process and return its result record"""
+    app_module = import_app_in_scratch_dir()
+    runner = {'split': run_split, 'stream': run_stream, 'upload': run_upload}[case['target']]
+    wall, timings, output_bytes = runner(app_module, case['image'], case['grid'], case['shape'])
+    pieces = case['grid'] * case['grid']
+    return dict(
+        case,
+        wall_s=wall,
+        stages_s=timings,
+        pieces=pieces,
+        pieces_per_s=pieces / wall,
+        output_bytes=output_bytes,
+        peak_rss_bytes=peak_rss_bytes()
+    )
+
+
+def run_case_in_subprocess(case):
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)],
+        check=True, capture_output=True, text=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def case_id(result):
+    return f"{result['target']}/{result['size']}/{result['grid']}x{result['grid']}/{result['shape']}"
+
+
+def compare(results, baseline_path, tolerance):
+    """Print cases that got slower or bigger than the baseline; count them"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {case_id(r): r for r in json.load(f)['results']}
+
+    regressions = 0
+    for result in results:
+        before = baseline.get(case_id(result))
+        if before is None:
+            continue
+        for metric in ('wall_s', 'peak_rss_bytes', 'output_bytes'):
+            old, new = before.get(metric), result.get(metric)
+            if old and new and new > old * (1 + tolerance):
+                regressions += 1
+                print(f"REGRESSION {case_id(result)} {metric}: {old:.4g} -> {new:.4g} "
+                      f"(+{new / old - 1:.0%})")
+    return regressions
+
+
+def format_row(result):
+    rss = result['peak_rss_bytes']
+    stages = ' '.join(f"{name}={seconds * 1000:.0f}ms"
+                      for name, seconds in result['stages_s'].items())
+    return (f"{case_id(result):<34} {result['wall_s']:>8.3f}s "
+            f"{result['pieces_per_s']:>9.0f} pc/s "
+            f"{(rss or 0) / 2**20:>7.0f} MiB {result['output_bytes'] / 2**20:>8.1f} MiB  {stages}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES, help='image sizes WxH')
+    parser.add_argument('--grids', type=int, nargs='+', default=DEFAULT_GRIDS)
+    parser.add_argument('--shapes', nargs='+', default=DEFAULT_SHAPES,
+                        choices=DEFAULT_SHAPES)
+    parser.add_argument('--targets', nargs='+', default=DEFAULT_TARGETS,
+                        choices=DEFAULT_TARGETS)
+    parser.add_argument('--output', default='bench_split.json', help='where to write results')
+    parser.add_argument('--compare', help='earlier results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown before flagging (default 0.2)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs per case; the fastest is kept (default 1)')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    image_dir = tempfile.mkdtemp(prefix='jigsaw-bench-images-')
+    results = []
+    for size in args.sizes:
+        width, height = map(int, size.split('x'))
+        image_path = os.path.join(image_dir, f"{size}.jpg")
+        synthetic_image(width, height).save(image_path, quality=90)
+        for target in args.targets:
+            for grid in args.grids:
+                for shape in args.shapes:
+                    case = {'target': target, 'size': size, 'grid': grid,
+                            'shape': shape, 'image': image_path}
+                    result = min((run_case_in_subprocess(case) for _ in range(args.repeat)),
+                                 key=lambda r: r['wall_s'])
+                    results.append(result)
+                    print(format_row(result), flush=True)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results
+        }, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
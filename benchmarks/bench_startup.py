@@ -0,0 +1,127 @@
+"""Benchmark cold start: import time and the first requests of a fresh process
+
+Every run is a new interpreter in a scratch working directory, timing the
+import of a module, create_app(), and then the first light request, the
+first upload and the first piece fetch. The module list shows what the
+import alone pulled in.
+
+    python benchmarks/bench_startup.py --repeat 5 --output startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+# Not taken from common, which imports NumPy and Pillow: the measured
+# processes must start from a bare interpreter
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('numpy', 'PIL', 'flask', 'slicer', 'solver')
+
+
+def loaded(names):
+    return [name for name in names if name in sys.modules]
+
+
+def run_import(module):
+    """Time importing module alone"""
+    start = time.perf_counter()
+    __import__(module)
+    return {'import_s': time.perf_counter() - start, 'loaded': loaded(HEAVY_MODULES)}
+
+
+def run_app(image_path):
+    """Time importing app, building an app and its first requests"""
+    start = time.perf_counter()
+    import app as app_module
+    result = {'import_s': time.perf_counter() - start, 'loaded': loaded(HEAVY_MODULES)}
+
+    start = time.perf_counter()
+    flask_app = app_module.create_app()
+    result['create_app_s'] = time.perf_counter() - start
+    result['created_dirs'] = sorted(os.listdir('.'))
+    client = flask_app.test_client()
+
+    start = time.perf_counter()
+    client.get('/cache/stats')
+    result['first_request_s'] = time.perf_counter() - start
+
+    with open(image_path, 'rb') as f:
+        image_bytes = f.read()
+    start = time.perf_counter()
+    job = client.post('/upload', data={
+        'image': (BytesIO(image_bytes), 'image.jpg'), 'rows': '4', 'cols': '4', 'seed': '1'
+    }).get_json()
+    while job['status'] not in ('done', 'failed'):
+        time.sleep(0.002)
+        job = client.get(job['statusUrl']).get_json()
+    result['first_upload_s'] = time.perf_counter() - start
+
+    piece = job['result']['pieces'][0]
+    start = time.perf_counter()
+    client.get(f"/static/pieces/{job['result']['puzzleId']}/{piece['filename']}")
+    result['first_piece_s'] = time.perf_counter() - start
+    return result
+
+
+def run_in_subprocess(case):
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)],
+        check=True, capture_output=True, text=True,
+        cwd=tempfile.mkdtemp(prefix='jigsaw-bench-'))
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def summarize(runs):
+    """Median of every timing across runs, plus what the first run loaded"""
+    summary = {name: statistics.median(run[name] for run in runs)
+               for name in runs[0] if name.endswith('_s')}
+    summary['loaded'] = runs[0]['loaded']
+    if 'created_dirs' in runs[0]:
+        summary['created_dirs'] = runs[0]['created_dirs']
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='fresh processes per case')
+    parser.add_argument('--size', default='1024x768', help='size WxH of the uploaded image')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        case = json.loads(args.case)
+        sys.path.insert(0, REPO_ROOT)
+        result = run_app(case['image']) if case['target'] == 'app' else run_import(case['target'])
+        print(json.dumps(result))
+        return
+
+    from common import synthetic_image
+
+    width, height = map(int, args.size.split('x'))
+    image_path = os.path.join(tempfile.mkdtemp(prefix='jigsaw-bench-images-'), 'image.jpg')
+    synthetic_image(width, height).save(image_path, quality=90)
+
+    results = {}
+    for target in ('slicer', 'app'):
+        runs = [run_in_subprocess({'target': target, 'image': image_path})
+                for _ in range(args.repeat)]
+        results[target] = summarize(runs)
+        timings = ' '.join(f"{name[:-2]}={seconds * 1000:.1f}ms"
+                           for name, seconds in results[target].items() if name.endswith('_s'))
+        print(f"{target:<7} {timings}")
+        print(f"{'':<7} loaded on import: {', '.join(results[target]['loaded']) or '-'}")
+    print(f"{'':<7} created by create_app: {', '.join(results['app']['created_dirs']) or '-'}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'repeat': args.repeat, 'size': args.size, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Helpers shared by the benchmark scripts"""
+import os
+import sys
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+
+def synthetic_image(width, height, seed=0):
+    """Photo-like test image: smooth colour gradients plus mild grain
+
+    Pure noise would defeat every encoder, and flat colour would flatter
+    them, so this sits in between.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    channels = []
+    for _ in range(3):
+        fx, fy, phase = rng.uniform(1, 6), rng.uniform(1, 6), rng.uniform(0, np.pi)
+        wave = np.sin(x / width * fx * np.pi + phase) * np.cos(y / height * fy * np.pi)
+        channels.append(127 + 100 * wave + rng.normal(0, 8, (height, width)))
+    pixels = np.clip(np.stack(channels, axis=-1), 0, 255).astype(np.uint8)
+    return Image.fromarray(pixels, 'RGB')
+
+
+def import_app_in_scratch_dir():
+    """Import app with a throwaway working directory
+
+    app creates its upload and piece folders relative to the working
+    directory, so benchmarks run in a temporary one to leave the checkout
+    untouched.
+    """
+    os.chdir(tempfile.mkdtemp(prefix='jigsaw-bench-'))
+    import app
+    return app
@@ -0,0 +1,190 @@
+"""Load test the session server with many simulated players
+
+Each player joins one of the sessions, then drags its own piece along a
+circle at a fixed rate. Latency is the time from sending a MOVE to seeing
+that position in an UPDATE; moves the server coalesced away never show up
+and are counted separately. Without --url a session server is started on a
+free local port for the duration of the run.
+
+    python benchmarks/load_test_sessions.py --players 300 --sessions 3 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+import websockets
+
+from common import REPO_ROOT
+
+from session_server import DROP, DROP_FORMAT, MOVE, MOVE_FORMAT, UPDATE, parse_update
+
+
+class Player:
+    def __init__(self, index, session, piece):
+        self.index = index
+        self.session = session
+        self.piece = piece
+        self.pending = {}
+        self.latencies = []
+        self.sent = 0
+        self.coalesced = 0
+        self.frames = 0
+        self.bytes = 0
+
+    def seen(self, x, received):
+        # Earlier moves that were overtaken by this one were coalesced
+        sent = self.pending.pop(x, None)
+        if sent is None:
+            return
+        self.latencies.append(received - sent)
+        stale = [key for key, value in self.pending.items() if value < sent]
+        for key in stale:
+            del self.pending[key]
+        self.coalesced += len(stale)
+
+
+async def receive(websocket, player):
+    async for message in websocket:
+        received = time.perf_counter()
+        if not isinstance(message, bytes) or message[0] != UPDATE:
+            continue
+        player.frames += 1
+        player.bytes += len(message)
+        _, moved, x, _, _, _, _ = parse_update(message)
+        hits = np.flatnonzero(moved == player.piece)
+        if len(hits):
+            player.seen(float(x[hits[0]]), received)
+
+
+async def play(url, player, args, stop_at):
+    async with websockets.connect(url, max_size=None) as websocket:
+        await websocket.send(json.dumps({
+            'type': 'join',
+            'session': player.session,
+            'rows': args.rows,
+            'cols': args.cols,
+            'pieceWidth': args.piece_size,
+            'pieceHeight': args.piece_size,
+            'seed': 1
+        }))
+        snapshot = json.loads(await websocket.recv())
+        if snapshot['type'] != 'snapshot':
+            raise RuntimeError(snapshot)
+
+        listener = asyncio.create_task(receive(websocket, player))
+        interval = 1 / args.rate
+        centre_x = snapshot['x'][player.piece]
+        centre_y = snapshot['y'][player.piece]
+        step = 0
+        loop = asyncio.get_running_loop()
+        next_send = loop.time() + interval * (player.index % 10) / 10
+        while loop.time() < stop_at:
+            await asyncio.sleep(max(0, next_send - loop.time()))
+            next_send += interval
+            step += 1
+            angle = step * 0.1
+            # Round through float32 so the echoed value matches exactly
+            x = float(np.float32(centre_x + 20 * math.cos(angle)))
+            y = float(np.float32(centre_y + 20 * math.sin(angle)))
+            player.pending[x] = time.perf_counter()
+            player.sent += 1
+            await websocket.send(MOVE_FORMAT.pack(MOVE, player.piece, x, y))
+        await websocket.send(DROP_FORMAT.pack(DROP, player.piece))
+        # Let the last updates arrive
+        await asyncio.sleep(0.5)
+        listener.cancel()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port):
+    server = subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, 'session_server.py'),
+                               '--port', str(port)], stdout=subprocess.PIPE, text=True)
+    # The server prints its address once it is listening
+    server.stdout.readline()
+    return server
+
+
+async def run(url, args):
+    pieces = args.rows * args.cols
+    players = [Player(i, f"load-{i % args.sessions}", (i // args.sessions) % pieces)
+               for i in range(args.players)]
+    stop_at = asyncio.get_running_loop().time() + args.duration
+    started = time.perf_counter()
+    await asyncio.gather(*(play(url, player, args, stop_at) for player in players))
+    return players, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='existing session server; default starts one locally')
+    parser.add_argument('--players', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=2)
+    parser.add_argument('--rows', type=int, default=20)
+    parser.add_argument('--cols', type=int, default=20)
+    parser.add_argument('--piece-size', type=int, default=40)
+    parser.add_argument('--rate', type=float, default=20, help='moves per second per player')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of dragging')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        port = free_port()
+        server = start_server(port)
+        url = f"ws://127.0.0.1:{port}/"
+    try:
+        players, elapsed = asyncio.run(run(url, args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    latencies = np.array([value for player in players for value in player.latencies]) * 1000
+    sent = sum(player.sent for player in players)
+    frames = sum(player.frames for player in players)
+    result = {
+        'players': args.players,
+        'sessions': args.sessions,
+        'seconds': elapsed,
+        'moves_per_second': sent / elapsed,
+        'updates_per_second': frames / elapsed,
+        'update_bytes_per_second': sum(player.bytes for player in players) / elapsed,
+        'moves_seen': len(latencies),
+        'moves_coalesced': sum(player.coalesced for player in players),
+        'latency_ms': {
+            'p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p95': float(np.percentile(latencies, 95)) if len(latencies) else None,
+            'p99': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'max': float(latencies.max()) if len(latencies) else None
+        }
+    }
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print(f"{result['players']} players in {result['sessions']} sessions for {elapsed:.1f} s")
+    print(f"  moves sent      {result['moves_per_second']:>10,.0f} /s")
+    print(f"  updates recv    {result['updates_per_second']:>10,.0f} /s "
+          f"({result['update_bytes_per_second'] / 1024:,.0f} KiB/s)")
+    print(f"  moves seen      {result['moves_seen']:>10,}  coalesced {result['moves_coalesced']:,}")
+    if len(latencies):
+        latency = result['latency_ms']
+        print(f"  latency ms      p50 {latency['p50']:.1f}  p95 {latency['p95']:.1f}  "
+              f"p99 {latency['p99']:.1f}  max {latency['max']:.1f}")
+
+
+if __name__ == '__main__':
+    main()
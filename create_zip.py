@@ -1,10 +1,15 @@
 import os
-import zipfile
 import shutil
 import sys
 
-def output_file(filename):
-    """Output the zip file with the given filename"""
+from puzzle_zip import app_entries, update_zip
+
+def output_file(filename, pieces=()):
+    """Output the zip file with the given filename
+
+    pieces names the files in static/pieces to include; other pieces there
+    are left out.
+    """
     print(f"Creating {filename}...")
     
     try:
@@ -53,6 +58,7 @@ pip install flask pillow numpy
 pillow==9.0.0
 numpy==1.22.0
 jinja2==3.0.1
+websockets==10.4
 """)
         
         # Create .gitkeep file for uploads directory
@@ -61,41 +67,12 @@ jinja2==3.0.1
         with open(gitkeep_path, 'w') as f:
             pass
         
-        # Create the zip file
+        # Package the app and only the given pieces, storing images as
+        # they are. An existing archive gets just the files that changed.
         zip_path = os.path.join(current_dir, filename)
-        print(f"Creating zip file at {zip_path}")
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            # Add all Python files
-            for file in os.listdir(current_dir):
-                if file.endswith('.py') or file == 'README.md' or file == 'requirements.txt':
-                    file_path = os.path.join(current_dir, file)
-                    print(f"Adding file: {file_path}")
-                    zipf.write(file_path, arcname=file)
-            
-            # Add templates directory
-            templates_dir = os.path.join(current_dir, 'templates')
-            for root, dirs, files in os.walk(templates_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, current_dir)
-                    print(f"Adding template: {arcname}")
-                    zipf.write(file_path, arcname=arcname)
-            
-            # Add static directory
-            static_dir = os.path.join(current_dir, 'static')
-            for root, dirs, files in os.walk(static_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, current_dir)
-                    print(f"Adding static file: {arcname}")
-                    zipf.write(file_path, arcname=arcname)
-            
-            # Add uploads directory (empty structure)
-            uploads_dir = os.path.join(current_dir, 'uploads')
-            gitkeep_path = os.path.join(uploads_dir, '.gitkeep')
-            arcname = os.path.relpath(gitkeep_path, current_dir)
-            print(f"Adding uploads structure: {arcname}")
-            zipf.write(gitkeep_path, arcname=arcname)
+        entries = app_entries(current_dir, pieces)
+        written, dropped = update_zip(zip_path, entries)
+        print(f"{len(entries)} files, {written} written, {dropped} dropped")
         
         print(f"{filename} created successfully at {zip_path}!")
         return zip_path
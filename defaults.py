@@ -0,0 +1,10 @@
+"""Defaults shared by the slicing engine and the web app
+
+Kept free of Pillow and Flask, so the app can read them without importing
+the slicer.
+"""
+import os
+
+PIECES_FOLDER = os.path.join('static', 'pieces')
+# Largest side of one atlas page; browsers refuse canvases much above this
+ATLAS_MAX_SIZE = 4096
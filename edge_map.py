@@ -0,0 +1,137 @@
+import base64
+import math
+
+import numpy as np
+
+# One tab as cubic Bezier segments in units of the tab size, running along a
+# side from u=0.4 to u=0.6 and bulging out to v=0.27. The curve is symmetric
+# about u=0.5, so a tab and the blank it fits into trace the same outline.
+TAB_CURVES = (
+    ((0.43, 0.0), (0.46, 0.05), (0.42, 0.1)),
+    ((0.36, 0.2), (0.4, 0.27), (0.5, 0.27)),
+    ((0.6, 0.27), (0.64, 0.2), (0.58, 0.1)),
+    ((0.54, 0.05), (0.57, 0.0), (0.6, 0.0)),
+)
+TAB_START = (0.4, 0.0)
+TAB_HEIGHT = 0.27
+
+# Each side traced clockwise: start corner, direction along it, outward normal
+_SIDE_FRAMES = {
+    'top': ((0, 0), (1, 0), (0, -1)),
+    'right': ((1, 0), (0, 1), (1, 0)),
+    'bottom': ((1, 1), (-1, 0), (0, 1)),
+    'left': ((0, 1), (0, -1), (-1, 0)),
+}
+
+
+class EdgeMap:
+    """Tab/blank layout of a puzzle stored as two seam arrays
+
+    horizontal[row, col] is the seam below piece (row, col) and
+    vertical[row, col] the seam to its right. A seam of 1 means the piece
+    above (or to the left) has a tab there and its neighbour a blank; -1 is
+    the reverse. Border sides are flat and are not stored at all.
+    """
+
+    def __init__(self, horizontal, vertical):
+        self.horizontal = np.asarray(horizontal, dtype=np.int8)
+        self.vertical = np.asarray(vertical, dtype=np.int8)
+        self.rows = self.vertical.shape[0]
+        self.cols = self.horizontal.shape[1]
+
+    @classmethod
+    def generate(cls, rows, cols, seed=None):
+        """Draw every seam at once from a seedable generator"""
+        rng = np.random.default_rng(seed)
+        horizontal = np.where(rng.random((rows - 1, cols)) < 0.5, 1, -1)
+        vertical = np.where(rng.random((rows, cols - 1)) < 0.5, 1, -1)
+        return cls(horizontal, vertical)
+
+    def sides(self):
+        """Edge type of every side of every piece, as (rows, cols) arrays
+
+        1 is a tab, -1 a blank and 0 a flat border, matching what
+        mask_engine.compose_alpha expects.
+        """
+        shape = (self.rows, self.cols)
+        top, right = np.zeros(shape, np.int8), np.zeros(shape, np.int8)
+        bottom, left = np.zeros(shape, np.int8), np.zeros(shape, np.int8)
+        bottom[:-1, :] = self.horizontal
+        top[1:, :] = -self.horizontal
+        right[:, :-1] = self.vertical
+        left[:, 1:] = -self.vertical
+        return {'top': top, 'right': right, 'bottom': bottom, 'left': left}
+
+    def piece(self, row, col):
+        """Side -> edge type for a single piece"""
+        return {
+            'top': -int(self.horizontal[row - 1, col]) if row > 0 else 0,
+            'right': int(self.vertical[row, col]) if col < self.cols - 1 else 0,
+            'bottom': int(self.horizontal[row, col]) if row < self.rows - 1 else 0,
+            'left': -int(self.vertical[row, col - 1]) if col > 0 else 0
+        }
+
+    def encode(self):
+        """Pack the seams into a short base64 string, one bit per seam
+
+        The horizontal seams come first, then the vertical ones, each in row
+        major order; a set bit is 1 and a clear bit -1. Bits fill each byte
+        from the most significant end.
+        """
+        bits = np.concatenate([self.horizontal.ravel(), self.vertical.ravel()]) > 0
+        return base64.b64encode(np.packbits(bits).tobytes()).decode('ascii')
+
+    @classmethod
+    def decode(cls, rows, cols, data):
+        """Rebuild an edge map from encode() output"""
+        horizontal_count = (rows - 1) * cols
+        vertical_count = rows * (cols - 1)
+        packed = np.frombuffer(base64.b64decode(data), dtype=np.uint8)
+        bits = np.unpackbits(packed)[:horizontal_count + vertical_count]
+        seams = np.where(bits, 1, -1).astype(np.int8)
+        return cls(seams[:horizontal_count].reshape(rows - 1, cols),
+                   seams[horizontal_count:].reshape(rows, cols - 1))
+
+    def __eq__(self, other):
+        return (isinstance(other, EdgeMap)
+                and np.array_equal(self.horizontal, other.horizontal)
+                and np.array_equal(self.vertical, other.vertical))
+
+
+def _number(value):
+    # One decimal is plenty for on-screen outlines; adding 0.0 drops "-0"
+    return f"{round(value, 1) + 0.0:g}"
+
+
+def tab_padding(width, height):
+    """How far a tab reaches beyond the side of a width x height piece"""
+    return math.ceil(TAB_HEIGHT * min(width, height))
+
+
+def piece_path(edges, width, height):
+    """SVG path data outlining one piece, with Bezier tabs and blanks
+
+    edges is a side -> edge type dict as returned by EdgeMap.piece(). The
+    path is in the piece's own coordinates with (0, 0) at the top left corner
+    of its grid cell; tabs reach up to tab_padding() beyond the cell.
+    """
+    size = min(width, height)
+
+    def point(side, u, v, kind):
+        (x0, y0), (dx, dy), (nx, ny) = _SIDE_FRAMES[side]
+        length = width if dx else height
+        along = length / 2 + (u - 0.5) * size
+        out = v * size * kind
+        return f"{_number(x0 * width + dx * along + nx * out)} {_number(y0 * height + dy * along + ny * out)}"
+
+    commands = ["M0 0"]
+    for side in ('top', 'right', 'bottom', 'left'):
+        kind = edges[side]
+        if kind:
+            commands.append("L" + point(side, *TAB_START, kind))
+            for curve in TAB_CURVES:
+                commands.append("C" + " ".join(point(side, u, v, kind) for u, v in curve))
+        (x0, y0), (dx, dy), _ = _SIDE_FRAMES[side]
+        commands.append(f"L{(x0 + dx) * width} {(y0 + dy) * height}")
+    commands[-1] = "Z"
+    return "".join(commands)
@@ -0,0 +1,85 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFull(Exception):
+    """Raised when the job queue already holds max_pending jobs"""
+
+
+class JobQueue:
+    """Bounded queue running slicing jobs on a few background threads
+
+    At most max_pending jobs may be queued or running at once; submit raises
+    QueueFull beyond that so the caller can shed load instead of piling up
+    work. Jobs submitted with the same key while one is still in flight share
+    it. Up to keep_finished finished jobs are remembered for polling, so
+    results should stay small.
+    """
+
+    def __init__(self, workers=2, max_pending=32, keep_finished=1000):
+        self.max_pending = max_pending
+        self.keep_finished = keep_finished
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='puzzle-job')
+        self._jobs = OrderedDict()
+        self._in_flight = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, key=None):
+        """Queue func(*args) and return its job id"""
+        with self._lock:
+            if key is not None and key in self._in_flight:
+                return self._in_flight[key]
+            if self._pending >= self.max_pending:
+                raise QueueFull(f"{self._pending} jobs already pending")
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {'status': 'queued', 'key': key, 'created': time.time()}
+            self._pending += 1
+            if key is not None:
+                self._in_flight[key] = job_id
+        self._executor.submit(self._run, job_id, func, args)
+        return job_id
+
+    def add_finished(self, result, key=None):
+        """Record a job that needed no work, e.g. a cache hit"""
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = {'status': 'done', 'key': key,
+                                  'created': time.time(), 'result': result}
+            self._forget_finished()
+        return job_id
+
+    def _run(self, job_id, func, args):
+        with self._lock:
+            self._jobs[job_id]['status'] = 'running'
+        try:
+            update = {'status': 'done', 'result': func(*args)}
+        except Exception as e:
+            update = {'status': 'failed', 'error': str(e)}
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(update)
+            self._pending -= 1
+            if job['key'] is not None:
+                self._in_flight.pop(job['key'], None)
+            self._forget_finished()
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job['status'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """Return a snapshot of the job, or None if it is unknown"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def stats(self):
+        with self._lock:
+            return {'pending': self._pending, 'known': len(self._jobs)}
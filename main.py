@@ -1,10 +1,22 @@
+import io
+import json
 import os
+import shutil
 import sys
+import tempfile
+import time
 import argparse
-import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def create_zip(filename="puzzle.zip"):
-    """Create a zip file containing all the necessary files for the jigsaw puzzle app"""
+from puzzle_cache import cache_key, directory_size
+from puzzle_zip import app_entries, update_zip
+
+def create_zip(filename="puzzle.zip", pieces=()):
+    """Create a zip file containing all the necessary files for the jigsaw puzzle app
+    
+    pieces names the files in static/pieces to include; other pieces there
+    are left out.
+    """
     print(f"Creating {filename}...")
     
     try:
@@ -55,6 +67,7 @@ pip install flask pillow numpy
 pillow==9.0.0
 numpy==1.22.0
 jinja2==3.0.1
+websockets==10.4
 """)
         
         # Create .gitkeep file for uploads directory
@@ -63,41 +76,12 @@ jinja2==3.0.1
         with open(gitkeep_path, 'w') as f:
             pass
         
-        # Create the zip file
+        # Package the app and only the pieces just cut, storing images as
+        # they are. An existing archive gets just the files that changed.
         zip_path = os.path.join(current_dir, filename)
-        print(f"Creating zip file at {zip_path}")
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            # Add all Python files
-            for file in os.listdir(current_dir):
-                if file.endswith('.py') or file == 'README.md' or file == 'requirements.txt':
-                    file_path = os.path.join(current_dir, file)
-                    print(f"Adding file: {file_path}")
-                    zipf.write(file_path, arcname=os.path.basename(file_path))
-            
-            # Add templates directory
-            templates_dir = os.path.join(current_dir, 'templates')
-            for root, dirs, files in os.walk(templates_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, current_dir)
-                    print(f"Adding template: {arcname}")
-                    zipf.write(file_path, arcname=arcname)
-            
-            # Add static directory
-            static_dir = os.path.join(current_dir, 'static')
-            for root, dirs, files in os.walk(static_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, current_dir)
-                    print(f"Adding static file: {arcname}")
-                    zipf.write(file_path, arcname=arcname)
-            
-            # Add uploads directory (empty structure)
-            uploads_dir = os.path.join(current_dir, 'uploads')
-            gitkeep_path = os.path.join(uploads_dir, '.gitkeep')
-            arcname = os.path.relpath(gitkeep_path, current_dir)
-            print(f"Adding uploads structure: {arcname}")
-            zipf.write(gitkeep_path, arcname=arcname)
+        entries = app_entries(current_dir, pieces)
+        written, dropped = update_zip(zip_path, entries)
+        print(f"{len(entries)} files, {written} written, {dropped} dropped")
         
         print(f"{filename} created successfully at {zip_path}!")
         return zip_path
@@ -107,12 +91,169 @@ jinja2==3.0.1
         traceback.print_exc()
         return None
 
-def output_file(filename):
+def output_file(filename, pieces=()):
     """Output the zip file with the given filename - this is the function called from outside"""
-    zip_path = create_zip(filename)
+    zip_path = create_zip(filename, pieces)
     print(f"Zip file created at: {zip_path}")
     return zip_path
 
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.gif')
+BATCH_MANIFEST = 'manifest.json'
+# Item fields that change what gets written; the manifest records them
+BATCH_SETTINGS = ('rows', 'cols', 'piece_shape', 'seed', 'output', 'format', 'stream')
+
+def batch_settings(item):
+    """Everything that shapes an item's output, as stored in its manifest"""
+    settings = {name: item.get(name) for name in BATCH_SETTINGS}
+    settings['image'] = os.path.abspath(item['image'])
+    return settings
+
+def batch_items(source, defaults):
+    """Puzzles to cut, from a directory of images or a JSON Lines manifest
+    
+    Every image in a directory is cut with the defaults. A manifest has one
+    object per line with an "image" path (relative to the manifest) and
+    optionally "id", "rows", "cols", "piece_shape", "seed", "output",
+    "format" and "stream" overriding the defaults. Items without an id are named after
+    the image and grid plus a hash of the image path and every setting, so
+    images of the same name or other settings never share a directory.
+    """
+    if os.path.isdir(source):
+        raw = [{'image': os.path.join(source, name)} for name in sorted(os.listdir(source))
+               if name.lower().endswith(IMAGE_EXTENSIONS)]
+    else:
+        base = os.path.dirname(os.path.abspath(source))
+        raw = []
+        with open(source, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    item['image'] = os.path.join(base, item['image'])
+                    raw.append(item)
+    
+    items = []
+    for entry in raw:
+        item = dict(defaults, **entry)
+        if not item.get('id'):
+            stem = os.path.splitext(os.path.basename(item['image']))[0]
+            digest = cache_key('batch', **batch_settings(item))[:8]
+            item['id'] = f"{stem}-{item['rows']}x{item['cols']}-{item['piece_shape']}-{digest}"
+        items.append(item)
+    return items
+
+def cut_batch_item(item, out_dir, workers=1):
+    """Cut one batch item into out_dir/<id> and write its manifest
+    
+    Runs in a batch worker process. The puzzle is built in a hidden scratch
+    directory and renamed into place once its manifest is written, so an
+    interrupted run never leaves a directory that looks finished. With
+    workers, the rendering pool is shut down again before returning: the
+    batch worker could not exit while it lives.
+    """
+    from slicer import (load_image, open_image, piece_encoding, puzzle_payload,
+                        shutdown_process_pools, split_image)
+    from edge_map import EdgeMap, tab_padding
+    from puzzle_cache import image_digest
+    
+    started = time.perf_counter()
+    with open(item['image'], 'rb') as f:
+        image_bytes = f.read()
+    # Like the server, derive the seed from the image so reruns agree
+    seed = item.get('seed')
+    if seed is None:
+        seed = int(image_digest(image_bytes)[:8], 16)
+    
+    rows, cols = item['rows'], item['cols']
+    output = item['output']
+    build_dir = tempfile.mkdtemp(prefix=f".{item['id']}-", dir=out_dir)
+    try:
+        stream = item.get('stream', False)
+        img = (open_image if stream else load_image)(io.BytesIO(image_bytes))
+        edge_map = EdgeMap.generate(rows, cols, seed)
+        pieces_info, piece_width, piece_height = split_image(
+            img, rows, cols, item['piece_shape'], output, build_dir, seed, workers=workers,
+            encoding=piece_encoding(item['format']), edge_map=edge_map, stream=stream)
+        
+        jigsaw = item['piece_shape'] == 'jigsaw'
+        padding = tab_padding(piece_width, piece_height) if jigsaw and output == 'vector' else 0
+        payload = puzzle_payload(item['id'], seed, pieces_info, img.size, piece_width, piece_height,
+                                 rows, cols, edge_map.encode() if jigsaw else None, padding)
+        payload['source'] = os.path.abspath(item['image'])
+        payload['settings'] = batch_settings(item)
+        with open(os.path.join(build_dir, BATCH_MANIFEST), 'w', encoding='utf-8') as f:
+            json.dump(payload, f)
+        # An earlier cut with other settings is replaced
+        target = os.path.join(out_dir, item['id'])
+        if os.path.exists(target):
+            stale_dir = tempfile.mkdtemp(prefix=f".{item['id']}-stale-", dir=out_dir)
+            os.rename(target, os.path.join(stale_dir, item['id']))
+            shutil.rmtree(stale_dir, ignore_errors=True)
+        os.rename(build_dir, target)
+    except Exception:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+    finally:
+        if workers > 1:
+            shutdown_process_pools()
+    
+    return {
+        'id': item['id'],
+        'pieces': len(pieces_info),
+        'megapixels': img.width * img.height / 1e6,
+        'bytes': directory_size(os.path.join(out_dir, item['id'])),
+        'seconds': time.perf_counter() - started
+    }
+
+def batch_done(item, out_dir):
+    """Whether out_dir already holds this item, cut with the same settings"""
+    try:
+        with open(os.path.join(out_dir, item['id'], BATCH_MANIFEST), encoding='utf-8') as f:
+            return json.load(f).get('settings') == batch_settings(item)
+    except (OSError, ValueError):
+        return False
+
+def run_batch(source, out_dir, defaults, jobs, workers=1):
+    """Cut every batch item across jobs processes and print a summary
+    
+    Items whose output directory already holds a manifest with the same
+    settings are skipped, so an interrupted import picks up where it left
+    off. Returns the number of items that failed.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    items = batch_items(source, defaults)
+    pending = [item for item in items if not batch_done(item, out_dir)]
+    skipped = len(items) - len(pending)
+    print(f"{len(items)} 件中 {skipped} 件は作成済みのためスキップします。")
+    
+    results, failures = [], []
+    started = time.perf_counter()
+    # Each process imports Pillow and the slicer once and then cuts whole
+    # puzzles, instead of one interpreter per image
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(cut_batch_item, item, out_dir, workers): item for item in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            item = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failures.append(item['id'])
+                print(f"[{done}/{len(pending)}] {item['id']}: エラー: {e}")
+                continue
+            results.append(result)
+            print(f"[{done}/{len(pending)}] {item['id']}: {result['pieces']} ピース "
+                  f"{result['seconds']:.2f} 秒")
+    elapsed = time.perf_counter() - started
+    
+    pieces = sum(result['pieces'] for result in results)
+    megapixels = sum(result['megapixels'] for result in results)
+    written = sum(result['bytes'] for result in results)
+    per_second = max(elapsed, 1e-9)
+    print(f"完了 {len(results)} 件 / スキップ {skipped} 件 / 失敗 {len(failures)} 件 "
+          f"({elapsed:.1f} 秒, {jobs} プロセス)")
+    print(f"  {len(results) / per_second:.2f} パズル/秒, {pieces / per_second:.0f} ピース/秒, "
+          f"{megapixels / per_second:.1f} MP/秒, {written / per_second / 1e6:.1f} MB/秒")
+    return len(failures)
+
 def main():
     """Main function to handle the jigsaw puzzle application"""
     parser = argparse.ArgumentParser(description='ジグソーパズル Web アプリ')
@@ -120,6 +261,18 @@ def main():
     parser.add_argument('--rows', type=int, default=4, help='行数 (既定 4)')
     parser.add_argument('--cols', type=int, default=4, help='列数 (既定 4)')
     parser.add_argument('--piece_shape', type=str, default='jigsaw', choices=['square', 'jigsaw'], help='ピース形状 (既定 jigsaw)')
+    parser.add_argument('--seed', type=int, default=None, help='凹凸パターンの乱数シード')
+    parser.add_argument('--workers', type=int, default=1, help='ピース生成に使うプロセス数 (既定 1)')
+    parser.add_argument('--batch', type=str, help='画像のディレクトリ、または JSON Lines のマニフェスト')
+    parser.add_argument('--out', type=str, default='batch_output', help='バッチの出力先 (既定 batch_output)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='同時に作成するパズル数 (既定 CPU 数)')
+    parser.add_argument('--output', type=str, default='files', choices=['files', 'atlas', 'vector'],
+                        help='バッチでのピースの出力形式 (既定 files)')
+    parser.add_argument('--format', type=str, default='png', choices=['png', 'png8', 'webp'],
+                        help='バッチでのピースの画像形式 (既定 png)')
+    parser.add_argument('--stream', action='store_true',
+                        help='ピースを1行ずつ切り出して書き出し、大きな画像でもメモリ使用量を抑える')
     
     args = parser.parse_args()
     
@@ -128,21 +281,30 @@ def main():
         output_file("puzzle.zip")
         return
     
+    if args.batch:
+        defaults = {'rows': args.rows, 'cols': args.cols, 'piece_shape': args.piece_shape,
+                    'seed': args.seed, 'output': args.output, 'format': args.format,
+                    'stream': args.stream}
+        failed = run_batch(args.batch, args.out, defaults, args.jobs, args.workers)
+        sys.exit(1 if failed else 0)
+    
     # If image is provided, process it
     if args.image:
-        from app import app, split_image
+        from slicer import split_image
         
         # Create necessary directories
         os.makedirs('static/pieces', exist_ok=True)
         
         # Process the image
         try:
-            pieces_info, piece_width, piece_height = split_image(args.image, args.rows, args.cols, args.piece_shape)
+            pieces_info, piece_width, piece_height = split_image(args.image, args.rows, args.cols, args.piece_shape,
+                                                                 seed=args.seed, workers=args.workers,
+                                                                 stream=args.stream)
             print(f"画像を {args.rows}x{args.cols} のピースに分割しました。")
             print(f"ピースは static/pieces/ ディレクトリに保存されています。")
             
-            # Create and output the zip file
-            output_file("puzzle.zip")
+            # Create and output the zip file with just these pieces
+            output_file("puzzle.zip", [piece['filename'] for piece in pieces_info])
         except Exception as e:
             print(f"エラー: {str(e)}")
     else:
@@ -0,0 +1,143 @@
+import time
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Order in which split_image has always drawn the edges. A blank drawn after a
+# tab can re-open pixels the tab cleared, so the order matters for overlaps.
+SIDES = ('top', 'right', 'bottom', 'left')
+
+
+def _ellipse_box(side, width, height, edge_size):
+    """Bounding box of the tab/blank ellipse for one side of a piece"""
+    if side == 'top':
+        return (width//2 - edge_size, -edge_size,
+                width//2 + edge_size, edge_size)
+    if side == 'right':
+        return (width - edge_size, height//2 - edge_size,
+                width + edge_size, height//2 + edge_size)
+    if side == 'bottom':
+        return (width//2 - edge_size, height - edge_size,
+                width//2 + edge_size, height + edge_size)
+    return (-edge_size, height//2 - edge_size,
+            edge_size, height//2 + edge_size)
+
+
+@lru_cache(maxsize=32)
+def get_stencils(width, height, edge_size):
+    """Build the tab/blank stencils for a piece size once
+
+    Each stencil is rasterised with the same ImageDraw.ellipse call the
+    per-piece masks used, so the footprint is pixel-identical. Returns a
+    dict of side -> (y0, y1, x0, x1, footprint) where footprint is the
+    boolean array clipped to its bounding box inside the piece.
+    """
+    stencils = {}
+    for side in SIDES:
+        canvas = Image.new('L', (width, height), 0)
+        ImageDraw.Draw(canvas).ellipse(_ellipse_box(side, width, height, edge_size), fill=255)
+        footprint = np.asarray(canvas) > 0
+        ys = np.flatnonzero(footprint.any(axis=1))
+        xs = np.flatnonzero(footprint.any(axis=0))
+        if ys.size == 0:
+            stencils[side] = None
+            continue
+        y0, y1 = ys[0], ys[-1] + 1
+        x0, x1 = xs[0], xs[-1] + 1
+        stencils[side] = (y0, y1, x0, x1, footprint[y0:y1, x0:x1])
+    return stencils
+
+
+def compose_alpha(edges, width, height, edge_size):
+    """Compose the alpha channel of every piece in one batch
+
+    edges maps each side name to a (rows, cols) integer array of edge types
+    (1: tab, -1: blank, 0: flat). Returns a (rows * height, cols * width)
+    uint8 array laid out like the grid area of the source image, so a single
+    putalpha covers every piece.
+    """
+    rows, cols = np.shape(edges['top'])
+    alpha = np.full((rows, height, cols, width), 255, dtype=np.uint8)
+    stencils = get_stencils(width, height, edge_size)
+
+    for side in SIDES:
+        stencil = stencils[side]
+        if stencil is None:
+            continue
+        y0, y1, x0, x1, footprint = stencil
+        region = alpha[:, y0:y1, :, x0:x1]
+        kinds = np.asarray(edges[side])
+        for kind, value in ((1, 0), (-1, 255)):
+            selected = kinds == kind
+            if not selected.any():
+                continue
+            hit = selected[:, None, :, None] & footprint[None, :, None, :]
+            region[hit] = value
+
+    return alpha.reshape(rows * height, cols * width)
+
+
+def piece_mask(edges, width, height, edge_size):
+    """Build the mask for a single piece from its side -> edge type dict"""
+    single = {side: np.array([[edges[side]]]) for side in SIDES}
+    return Image.fromarray(compose_alpha(single, width, height, edge_size), 'L')
+
+
+def legacy_piece_mask(edges, width, height, edge_size):
+    """Reference implementation: one ImageDraw pass per piece"""
+    mask = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(mask)
+    for side in SIDES:
+        if edges[side] == 1:
+            draw.ellipse(_ellipse_box(side, width, height, edge_size), fill=0)
+        elif edges[side] == -1:
+            draw.ellipse(_ellipse_box(side, width, height, edge_size), fill=255)
+    return mask
+
+
+def benchmark(rows=40, cols=40, width=100, height=75, repeat=3, seed=0):
+    """Compare the batched engine with the per-piece masks
+
+    Checks the two produce identical pixels and returns the best-of-repeat
+    timings in seconds together with the speed-up factor.
+    """
+    from edge_map import EdgeMap
+
+    edge_size = min(width, height) // 5
+    edges = EdgeMap.generate(rows, cols, seed).sides()
+
+    def run_legacy():
+        plane = Image.new('L', (cols * width, rows * height))
+        for row in range(rows):
+            for col in range(cols):
+                piece_edges = {side: int(edges[side][row, col]) for side in SIDES}
+                mask = legacy_piece_mask(piece_edges, width, height, edge_size)
+                plane.paste(mask, (col * width, row * height))
+        return np.asarray(plane)
+
+    def run_engine():
+        return compose_alpha(edges, width, height, edge_size)
+
+    if not np.array_equal(run_legacy(), run_engine()):
+        raise AssertionError("mask engine output differs from the per-piece masks")
+
+    timings = {}
+    for name, func in (('legacy', run_legacy), ('engine', run_engine)):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best
+    timings['speedup'] = timings['legacy'] / timings['engine']
+    return timings
+
+
+if __name__ == '__main__':
+    for grid, size in ((10, (200, 150)), (40, (100, 75)), (40, (250, 200))):
+        result = benchmark(grid, grid, *size)
+        print(f"{grid}x{grid} pieces of {size[0]}x{size[1]}: "
+              f"legacy {result['legacy'] * 1000:.1f} ms, "
+              f"engine {result['engine'] * 1000:.1f} ms "
+              f"({result['speedup']:.1f}x faster)")
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+METADATA_FILENAME = 'puzzle.json'
+
+
+def image_digest(image_bytes):
+    """Content hash of the uploaded image"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def cache_key(digest, **params):
+    """Key a puzzle on the image hash and every parameter that shapes it"""
+    encoded = json.dumps(params, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(f"{digest}:{encoded}".encode('utf-8')).hexdigest()[:32]
+
+
+def directory_size(path):
+    """Total size in bytes of the files in a puzzle directory"""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+class PuzzleCache:
+    """LRU cache of finished puzzle directories under a root folder
+
+    Every entry is a directory named after its key holding the piece assets
+    and a puzzle.json with the /upload payload. Entries are evicted least
+    recently used first once either max_entries or max_bytes is exceeded.
+    Recency survives restarts through the directory mtime.
+    """
+
+    def __init__(self, root, max_entries=100, max_bytes=512 * 1024 * 1024):
+        self.root = root
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Pick up entries left by a previous run, oldest first"""
+        found = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isfile(os.path.join(path, METADATA_FILENAME)):
+                found.append((os.path.getmtime(path), name))
+        for _, name in sorted(found):
+            self._entries[name] = directory_size(os.path.join(self.root, name))
+        with self._lock:
+            self._evict()
+
+    @property
+    def total_bytes(self):
+        return sum(self._entries.values())
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        """Return the stored payload for key, or None on a miss"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            os.utime(self.path(key))
+            with open(os.path.join(self.path(key), METADATA_FILENAME), encoding='utf-8') as f:
+                return json.load(f)
+        except OSError:
+            # The directory vanished underneath us; treat it as a miss
+            with self._lock:
+                self._entries.pop(key, None)
+                self.hits -= 1
+                self.misses += 1
+            return None
+
+    def payload(self, key):
+        """Return the stored payload for key without counting a hit, or None"""
+        try:
+            with open(os.path.join(self.path(key), METADATA_FILENAME), encoding='utf-8') as f:
+                return json.load(f)
+        except OSError:
+            return None
+
+    def put(self, key, build_dir, payload):
+        """Adopt a freshly built puzzle directory as the entry for key
+
+        build_dir is moved into place so readers never see a half-written
+        entry. If another request stored the same key first, build_dir is
+        discarded.
+        """
+        with open(os.path.join(build_dir, METADATA_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(payload, f)
+        size = directory_size(build_dir)
+        try:
+            os.rename(build_dir, self.path(key))
+        except OSError:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            if not os.path.isdir(self.path(key)):
+                raise
+        with self._lock:
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def grow(self, key, nbytes):
+        """Count nbytes more for an entry, e.g. a piece rendered after put
+
+        The entry counts as just used, and older ones are evicted if that
+        takes the cache over budget.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return
+            self._entries[key] += nbytes
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _over_budget(self):
+        return (len(self._entries) > self.max_entries
+                or self.total_bytes > self.max_bytes)
+
+    def _evict(self):
+        # The newest entry is kept even when it alone exceeds the budget
+        while len(self._entries) > 1 and self._over_budget():
+            key, _ = self._entries.popitem(last=False)
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,170 @@
+"""Zip packaging for the app and its puzzles
+
+Archives are produced as a stream of chunks, so they can be written to
+disk or sent as an HTTP response without holding them in memory. Images are
+stored as they are: PNG and WebP are already compressed, and deflating them
+again costs CPU for next to no saving.
+"""
+import os
+import time
+import zipfile
+
+# Already compressed formats, stored without deflate
+STORED_EXTENSIONS = frozenset(['.png', '.webp', '.jpg', '.jpeg', '.gif', '.zip'])
+CHUNK_SIZE = 64 * 1024
+
+
+def compress_type(path):
+    extension = os.path.splitext(path)[1].lower()
+    return zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def directory_entries(root, arc_prefix='', exclude=()):
+    """(path, arcname) for every file under root, in a stable order
+
+    exclude lists directories, relative to root, that are left out along
+    with everything below them. Hidden directories (in-progress builds) are
+    always skipped.
+    """
+    exclude = {os.path.normpath(path) for path in exclude}
+    entries = []
+    for directory, dirs, files in os.walk(root):
+        relative = os.path.relpath(directory, root)
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.')
+                         and os.path.normpath(os.path.join(relative, name)) not in exclude)
+        for name in sorted(files):
+            arcname = os.path.normpath(os.path.join(arc_prefix, relative, name))
+            entries.append((os.path.join(directory, name), arcname.replace(os.sep, '/')))
+    return entries
+
+
+def app_entries(root, pieces=()):
+    """Files that make up the packaged app under root
+
+    The top-level Python files, README.md, requirements.txt, templates/,
+    static/ and uploads/.gitkeep. Of static/pieces only the given piece
+    filenames are included, so stale pieces and cached server puzzles stay
+    out of the archive.
+    """
+    entries = []
+    for name in sorted(os.listdir(root)):
+        if name.endswith('.py') or name in ('README.md', 'requirements.txt'):
+            entries.append((os.path.join(root, name), name))
+    entries += directory_entries(os.path.join(root, 'templates'), 'templates')
+    entries += directory_entries(os.path.join(root, 'static'), 'static', exclude=['pieces'])
+    for filename in pieces:
+        entries.append((os.path.join(root, 'static', 'pieces', filename), f"static/pieces/{filename}"))
+    gitkeep = os.path.join(root, 'uploads', '.gitkeep')
+    if os.path.exists(gitkeep):
+        entries.append((gitkeep, 'uploads/.gitkeep'))
+    return entries
+
+
+class _ChunkBuffer:
+    """Write-only file object that collects what ZipFile writes
+
+    It has no tell() or seek(), so ZipFile streams: sizes and CRCs go in a
+    data descriptor after each entry instead of being patched in later.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def _zip_info(path, arcname):
+    info = zipfile.ZipInfo.from_file(path, arcname, strict_timestamps=False)
+    info.compress_type = compress_type(path)
+    return info
+
+
+def iter_zip(entries, chunk_size=CHUNK_SIZE):
+    """Yield a zip archive of entries, (path, arcname) pairs, in chunks
+
+    Files are read chunk_size bytes at a time, so memory use stays flat
+    however large the archive gets.
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        for path, arcname in entries:
+            with open(path, 'rb') as source, zf.open(_zip_info(path, arcname), 'w') as target:
+                for block in iter(lambda: source.read(chunk_size), b''):
+                    target.write(block)
+                    if buffer.size >= chunk_size:
+                        yield buffer.take()
+            if buffer.size >= chunk_size:
+                yield buffer.take()
+    yield buffer.take()
+
+
+def write_zip(path, entries, chunk_size=CHUNK_SIZE):
+    """Stream a fresh archive of entries to path, replacing it atomically"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as f:
+        for chunk in iter_zip(entries, chunk_size):
+            f.write(chunk)
+    os.replace(temp_path, path)
+    return path
+
+
+def _unchanged(info, path):
+    # Zip timestamps have two second resolution
+    stat = os.stat(path)
+    modified = time.localtime(stat.st_mtime)[:6]
+    modified = modified[:5] + (modified[5] // 2 * 2,)
+    return info.file_size == stat.st_size and info.date_time == modified
+
+
+def update_zip(path, entries, max_waste=0.5):
+    """Bring the archive at path up to date with entries
+
+    New and changed files are appended and the entries they replace, or
+    that are no longer wanted, are dropped from the central directory. A
+    file counts as changed when its size or modification time differs from
+    the archived copy. Dropped data stays in the file as dead space; once
+    that would pass max_waste of the archive it is rewritten from scratch.
+
+    Returns (written, dropped) entry counts. The update is done in place,
+    so nothing should read the archive meanwhile.
+    """
+    if not os.path.exists(path):
+        write_zip(path, entries)
+        return len(entries), 0
+
+    wanted = {arcname: source for source, arcname in entries}
+    with zipfile.ZipFile(path) as zf:
+        current = {info.filename: info for info in zf.infolist()}
+    dropped = {name for name, info in current.items()
+               if name not in wanted or not _unchanged(info, wanted[name])}
+    fresh = [(source, arcname) for arcname, source in wanted.items()
+             if arcname not in current or arcname in dropped]
+    if not fresh and not dropped:
+        return 0, 0
+
+    kept = sum(info.compress_size for name, info in current.items() if name not in dropped)
+    waste = os.path.getsize(path) - kept
+    fresh_bytes = sum(os.path.getsize(source) for source, _ in fresh)
+    if not fresh or waste > max_waste * (kept + waste + fresh_bytes):
+        write_zip(path, entries)
+        return len(entries), len(dropped)
+
+    with zipfile.ZipFile(path, 'a', strict_timestamps=False) as zf:
+        for name in dropped:
+            zf.filelist.remove(zf.NameToInfo.pop(name))
+        for source, arcname in fresh:
+            zf.write(source, arcname, compress_type=compress_type(source))
+    return len(fresh), len(dropped)
@@ -0,0 +1,333 @@
+"""Shared puzzle sessions served over WebSockets
+
+    python session_server.py --port 8765
+
+Players connect to ws://host:port/ and first send a JSON join message with
+the session to join and the puzzle geometry from the /upload result:
+
+    {"type": "join", "session": "abc", "rows": 10, "cols": 10,
+     "pieceWidth": 60, "pieceHeight": 40}
+
+The first player creates the session and its pieces are scattered over the
+board; every player then gets a JSON snapshot of all positions, group roots
+and lock flags. After that players send small binary frames:
+
+    MOVE    <B 1> <I piece> <f x> <f y>   move piece's group so piece is at x, y
+    DROP    <B 3> <I piece>               let go: snap to neighbours or board
+
+The server owns the state. Moves and drops are coalesced per group and
+applied once per tick, and every tick that changed something sends the session a single
+binary UPDATE frame:
+
+    <B 2> <I tick> <I moved> <I regrouped>
+    moved     x <I index gap>   sorted, each minus the previous (first minus -1)
+    moved     x <f x>
+    moved     x <f y>
+    regrouped x <I piece>
+    regrouped x <I root>
+    regrouped x <B locked>
+
+Only pieces that changed during the tick are listed. Once every piece has
+joined one group the session also gets {"type": "complete"}.
+"""
+import argparse
+import asyncio
+import json
+import struct
+
+import numpy as np
+import websockets
+
+TICK_SECONDS = 1 / 30
+# 100 x 100 is the largest grid index.html offers
+MAX_PIECES = 100 * 100
+
+MOVE = 1
+UPDATE = 2
+DROP = 3
+
+MOVE_FORMAT = struct.Struct('<BIff')
+DROP_FORMAT = struct.Struct('<BI')
+UPDATE_HEADER = struct.Struct('<BIII')
+
+
+class Session:
+    """Authoritative piece positions and groups of one shared puzzle
+
+    Positions, union-find parents and lock flags are NumPy arrays indexed by
+    piece (row * cols + col). Each union-find root also keeps the list of its
+    members, so moving or locking a group touches only that group.
+    """
+
+    def __init__(self, session_id, rows, cols, piece_width, piece_height, seed=None):
+        self.id = session_id
+        self.rows = rows
+        self.cols = cols
+        self.piece_width = piece_width
+        self.piece_height = piece_height
+        count = rows * cols
+        width, height = cols * piece_width, rows * piece_height
+
+        rng = np.random.default_rng(seed)
+        self.x = (rng.random(count) * max(1, width - piece_width)).astype(np.float32)
+        self.y = (rng.random(count) * max(1, height - piece_height)).astype(np.float32)
+        index = np.arange(count)
+        self.correct_x = (index % cols * piece_width).astype(np.float32)
+        self.correct_y = (index // cols * piece_height).astype(np.float32)
+        self.parent = index.astype(np.int32)
+        self.locked = np.zeros(count, dtype=np.uint8)
+        self.members = [[i] for i in range(count)]
+        self.groups = count
+        # A third of a cell, as in the browser
+        self.snap_distance = min(piece_width, piece_height) / 3
+
+        self.players = set()
+        self.tick = 0
+        self.completed = False
+        self._moves = {}
+        self._drops = {}
+        self._moved = set()
+        self._regrouped = set()
+
+    def find(self, piece):
+        parent = self.parent
+        while parent[piece] != piece:
+            parent[piece] = parent[parent[piece]]
+            piece = int(parent[piece])
+        return piece
+
+    def snapshot(self):
+        return {
+            'type': 'snapshot',
+            'session': self.id,
+            'tick': self.tick,
+            'rows': self.rows,
+            'cols': self.cols,
+            'pieceWidth': self.piece_width,
+            'pieceHeight': self.piece_height,
+            'x': self.x.tolist(),
+            'y': self.y.tolist(),
+            'root': [self.find(i) for i in range(len(self.parent))],
+            'locked': self.locked.tolist(),
+            'players': len(self.players)
+        }
+
+    def receive(self, message):
+        """Queue a binary MOVE or DROP frame for the next tick"""
+        # An empty frame falls through to the error below
+        kind = message[0] if message else None
+        if kind == MOVE and len(message) == MOVE_FORMAT.size:
+            _, piece, x, y = MOVE_FORMAT.unpack(message)
+            if piece < len(self.parent) and np.isfinite(x) and np.isfinite(y):
+                # Later moves of the same group replace earlier ones
+                self._moves[self.find(piece)] = (piece, x, y)
+        elif kind == DROP and len(message) == DROP_FORMAT.size:
+            _, piece = DROP_FORMAT.unpack(message)
+            if piece < len(self.parent):
+                # One drop per group and tick is enough: the group moves as one
+                self._drops[self.find(piece)] = piece
+        else:
+            raise ValueError(f"Unknown message of {len(message)} bytes")
+
+    def _move_group(self, root, dx, dy):
+        if not dx and not dy:
+            return
+        members = self.members[root]
+        self.x[members] += dx
+        self.y[members] += dy
+        self._moved.update(members)
+
+    def _lock_group(self, root):
+        members = self.members[root]
+        self.locked[members] = 1
+        self._regrouped.update(members)
+
+    def _union(self, root, other_root):
+        if len(self.members[root]) < len(self.members[other_root]):
+            root, other_root = other_root, root
+        self.parent[other_root] = root
+        self._regrouped.update(self.members[other_root])
+        self.members[root].extend(self.members[other_root])
+        self.members[other_root] = None
+        self.groups -= 1
+        return root
+
+    def _neighbours(self, piece):
+        row, col = divmod(piece, self.cols)
+        if row > 0:
+            yield piece - self.cols
+        if row < self.rows - 1:
+            yield piece + self.cols
+        if col > 0:
+            yield piece - 1
+        if col < self.cols - 1:
+            yield piece + 1
+
+    def drop(self, piece):
+        """Join the piece's group to aligned neighbours, then pin it to the board"""
+        distance = self.snap_distance
+        root = self.find(piece)
+        for member in list(self.members[root]):
+            for other in self._neighbours(member):
+                root, other_root = self.find(member), self.find(other)
+                if root == other_root:
+                    continue
+                dx = float(self.x[other] + self.correct_x[member] - self.correct_x[other] - self.x[member])
+                dy = float(self.y[other] + self.correct_y[member] - self.correct_y[other] - self.y[member])
+                if abs(dx) >= distance or abs(dy) >= distance:
+                    continue
+                # A locked group stays put; the loose one comes to it
+                if self.locked[root]:
+                    self._move_group(other_root, -dx, -dy)
+                else:
+                    self._move_group(root, dx, dy)
+                locked = self.locked[root] or self.locked[other_root]
+                merged = self._union(root, other_root)
+                if locked:
+                    self._lock_group(merged)
+
+        root = self.find(piece)
+        if not self.locked[root]:
+            dx = float(self.correct_x[piece] - self.x[piece])
+            dy = float(self.correct_y[piece] - self.y[piece])
+            if abs(dx) < distance and abs(dy) < distance:
+                self._move_group(root, dx, dy)
+                self._lock_group(root)
+
+    def step(self):
+        """Apply this tick's moves and drops; return the UPDATE frame or None"""
+        moves, self._moves = self._moves, {}
+        drops, self._drops = self._drops, {}
+        for piece, x, y in moves.values():
+            root = self.find(piece)
+            if not self.locked[root]:
+                self._move_group(root, x - float(self.x[piece]), y - float(self.y[piece]))
+        for piece in drops.values():
+            self.drop(piece)
+
+        self.tick += 1
+        if not self._moved and not self._regrouped:
+            return None
+
+        moved = np.array(sorted(self._moved), dtype=np.uint32)
+        regrouped = np.array(sorted(self._regrouped), dtype=np.uint32)
+        self._moved.clear()
+        self._regrouped.clear()
+        gaps = np.diff(moved.astype(np.int64), prepend=-1).astype(np.uint32)
+        roots = np.array([self.find(int(piece)) for piece in regrouped], dtype=np.uint32)
+        return b''.join([
+            UPDATE_HEADER.pack(UPDATE, self.tick, len(moved), len(regrouped)),
+            gaps.tobytes(),
+            self.x[moved].tobytes(),
+            self.y[moved].tobytes(),
+            regrouped.tobytes(),
+            roots.tobytes(),
+            self.locked[regrouped].tobytes()
+        ])
+
+
+def parse_update(frame):
+    """Decode an UPDATE frame into (tick, moved, x, y, regrouped, roots, locked)"""
+    _, tick, moved_count, regrouped_count = UPDATE_HEADER.unpack_from(frame)
+    offset = UPDATE_HEADER.size
+
+    def take(dtype, count):
+        nonlocal offset
+        values = np.frombuffer(frame, dtype=dtype, count=count, offset=offset)
+        offset += values.nbytes
+        return values
+
+    moved = np.cumsum(take('<u4', moved_count).astype(np.int64)) - 1
+    x = take('<f4', moved_count)
+    y = take('<f4', moved_count)
+    regrouped = take('<u4', regrouped_count)
+    roots = take('<u4', regrouped_count)
+    locked = take('u1', regrouped_count)
+    return tick, moved, x, y, regrouped, roots, locked
+
+
+sessions = {}
+
+
+def join_session(request):
+    """Find or create the session a join message asks for"""
+    if not isinstance(request, dict) or request.get('type') != 'join' or not request.get('session'):
+        raise ValueError("First message must be a join with a session id")
+    session = sessions.get(request['session'])
+    if session is not None:
+        return session
+
+    rows, cols = int(request['rows']), int(request['cols'])
+    piece_width, piece_height = int(request['pieceWidth']), int(request['pieceHeight'])
+    if rows < 1 or cols < 1 or rows * cols > MAX_PIECES:
+        raise ValueError(f"A session holds 1 to {MAX_PIECES} pieces")
+    if piece_width < 1 or piece_height < 1:
+        raise ValueError("Pieces need a positive size")
+    session = Session(request['session'], rows, cols, piece_width, piece_height,
+                      request.get('seed'))
+    sessions[session.id] = session
+    return session
+
+
+async def handle_player(websocket):
+    try:
+        session = join_session(json.loads(await websocket.recv()))
+    except (ValueError, KeyError, TypeError) as e:
+        await websocket.send(json.dumps({'type': 'error', 'error': str(e)}))
+        return
+
+    session.players.add(websocket)
+    try:
+        await websocket.send(json.dumps(session.snapshot()))
+        async for message in websocket:
+            if isinstance(message, bytes):
+                try:
+                    session.receive(message)
+                except ValueError as e:
+                    await websocket.send(json.dumps({'type': 'error', 'error': str(e)}))
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        session.players.discard(websocket)
+        if not session.players:
+            sessions.pop(session.id, None)
+
+
+async def run_ticks(tick_seconds=TICK_SECONDS):
+    """Step every session once per tick and broadcast what changed"""
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
+    while True:
+        next_tick += tick_seconds
+        await asyncio.sleep(max(0, next_tick - loop.time()))
+        for session in list(sessions.values()):
+            frame = session.step()
+            if frame is None:
+                continue
+            # broadcast never waits on a slow player; it just skips them
+            websockets.broadcast(session.players, frame)
+            if session.groups == 1 and not session.completed:
+                session.completed = True
+                websockets.broadcast(session.players, json.dumps({'type': 'complete'}))
+
+
+async def serve(host, port, tick_seconds=TICK_SECONDS):
+    # Positions barely deflate, and compressing every broadcast once per
+    # player costs more CPU than the bytes it saves
+    async with websockets.serve(handle_player, host, port, compression=None):
+        print(f"Puzzle sessions on ws://{host}:{port}/", flush=True)
+        await run_ticks(tick_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='共同で解くパズルのセッションサーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--tick', type=float, default=TICK_SECONDS,
+                        help='状態をまとめて配信する間隔（秒）')
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.tick))
+
+
+if __name__ == '__main__':
+    main()
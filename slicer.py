@@ -0,0 +1,569 @@
+"""The slicing engine: cut an image into puzzle pieces and save them
+
+Kept free of Flask so the command line tools and batch workers can cut
+puzzles without importing the web app.
+"""
+import multiprocessing
+import os
+import random
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw, UnidentifiedImageError
+
+from defaults import ATLAS_MAX_SIZE, PIECES_FOLDER
+from edge_map import EdgeMap, piece_path
+from mask_engine import compose_alpha, piece_mask
+
+PIECE_FORMATS = ('png', 'png8', 'webp')
+PIECE_SHAPES = ('jigsaw', 'square')
+
+def create_jigsaw_mask(width, height, edge_size=20):
+    """Create a jigsaw-like mask for a puzzle piece"""
+    mask = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(mask)
+    
+    # Define the tab/blank pattern for each edge
+    edges = {
+        'top': random.choice([1, -1]),     # 1: tab, -1: blank
+        'right': random.choice([1, -1]),
+        'bottom': random.choice([1, -1]),
+        'left': random.choice([1, -1])
+    }
+    
+    # Draw the edges
+    for edge, direction in edges.items():
+        if edge == 'top' and direction == 1:
+            # Draw a tab on top edge
+            draw.ellipse((width//2 - edge_size, -edge_size, 
+                         width//2 + edge_size, edge_size), fill=0)
+        elif edge == 'top' and direction == -1:
+            # Draw a blank on top edge
+            draw.ellipse((width//2 - edge_size, -edge_size, 
+                         width//2 + edge_size, edge_size), fill=255)
+            
+        if edge == 'right' and direction == 1:
+            # Draw a tab on right edge
+            draw.ellipse((width - edge_size, height//2 - edge_size, 
+                         width + edge_size, height//2 + edge_size), fill=0)
+        elif edge == 'right' and direction == -1:
+            # Draw a blank on right edge
+            draw.ellipse((width - edge_size, height//2 - edge_size, 
+                         width + edge_size, height//2 + edge_size), fill=255)
+            
+        if edge == 'bottom' and direction == 1:
+            # Draw a tab on bottom edge
+            draw.ellipse((width//2 - edge_size, height - edge_size, 
+                         width//2 + edge_size, height + edge_size), fill=0)
+        elif edge == 'bottom' and direction == -1:
+            # Draw a blank on bottom edge
+            draw.ellipse((width//2 - edge_size, height - edge_size, 
+                         width//2 + edge_size, height + edge_size), fill=255)
+            
+        if edge == 'left' and direction == 1:
+            # Draw a tab on left edge
+            draw.ellipse((-edge_size, height//2 - edge_size, 
+                         edge_size, height//2 + edge_size), fill=0)
+        elif edge == 'left' and direction == -1:
+            # Draw a blank on left edge
+            draw.ellipse((-edge_size, height//2 - edge_size, 
+                         edge_size, height//2 + edge_size), fill=255)
+    
+    return mask, edges
+
+_process_pools = {}
+_process_pool_lock = threading.Lock()
+
+def get_process_pool(workers):
+    """Return the rendering pool with this many workers, creating it once
+
+    Pools are kept per size and never shut down here, so a caller still
+    submitting to one is not cut off when another asks for a different
+    size. Workers are started by a fork server (or spawned where there is
+    none): forking the threaded web server could copy a lock some other
+    thread was holding and deadlock the child.
+    """
+    with _process_pool_lock:
+        if workers not in _process_pools:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context(
+                'forkserver' if 'forkserver' in methods else 'spawn')
+            _process_pools[workers] = ProcessPoolExecutor(max_workers=workers,
+                                                          mp_context=context)
+        return _process_pools[workers]
+
+def shutdown_process_pools():
+    """Shut down every rendering pool and wait for its workers to exit
+
+    For processes that are about to exit themselves, such as batch workers:
+    a live pool keeps its owner from exiting.
+    """
+    with _process_pool_lock:
+        pools = list(_process_pools.values())
+        _process_pools.clear()
+    for pool in pools:
+        pool.shutdown()
+
+def piece_encoding(piece_format='png', compress_level=6, quality=90):
+    """Encoding settings for pieces, as split_image and save_image take them"""
+    return {
+        'format': piece_format,
+        'compressLevel': compress_level,
+        'quality': quality
+    }
+
+def file_extension(encoding):
+    return 'webp' if encoding['format'] == 'webp' else 'png'
+
+def save_image(img, path, encoding):
+    """Save a piece or atlas page; also a picklable task for the process pool"""
+    if encoding['format'] == 'webp':
+        # Lossy colour, lossless alpha so the tab outlines stay crisp
+        img.save(path, 'WEBP', quality=encoding['quality'], method=4)
+    elif encoding['format'] == 'png8':
+        palette = img.quantize(256, method=Image.FASTOCTREE)
+        palette.save(path, 'PNG', compress_level=encoding['compressLevel'])
+    else:
+        img.save(path, 'PNG', compress_level=encoding['compressLevel'])
+
+def piece_info(row, col, piece_width, piece_height, extension='png'):
+    """Description of one piece as sent to the client"""
+    return {
+        'id': f"{row}_{col}",
+        'row': row,
+        'col': col,
+        'filename': f"piece_{row}_{col}.{extension}",
+        'width': piece_width,
+        'height': piece_height,
+        'correctX': col * piece_width,
+        'correctY': row * piece_height
+    }
+
+def render_piece(img, row, col, piece_width, piece_height, piece_shape, edges):
+    """Cut and mask a single piece from the source image
+
+    Produces the same pixels split_image would for that piece; edges is the
+    piece's side -> edge type dict from EdgeMap.piece().
+    """
+    left = col * piece_width
+    upper = row * piece_height
+    piece = img.crop((left, upper, left + piece_width, upper + piece_height))
+    if piece_shape == 'jigsaw':
+        edge_size = min(piece_width, piece_height) // 5
+        piece.putalpha(piece_mask(edges, piece_width, piece_height, edge_size))
+    return piece
+
+def save_pieces(img, rows, cols, piece_width, piece_height, output_dir, first_row=0,
+                encoding=None):
+    """Save every piece as its own PNG file
+
+    img may also be a band of the grid whose top edge is piece row
+    first_row, which is how worker processes receive their share.
+    """
+    pieces_info = []
+    band_top = first_row * piece_height
+    
+    for row in range(first_row, first_row + rows):
+        for col in range(cols):
+            # Calculate piece position
+            left = col * piece_width
+            upper = row * piece_height
+            right = left + piece_width
+            lower = upper + piece_height
+            
+            # Crop the piece from the original image
+            piece = img.crop((left, upper - band_top, right, lower - band_top))
+            
+            # Save the piece and store its information
+            info = piece_info(row, col, piece_width, piece_height, file_extension(encoding))
+            save_image(piece, os.path.join(output_dir, info['filename']), encoding)
+            pieces_info.append(info)
+    
+    return pieces_info
+
+def save_pieces_parallel(img, rows, cols, piece_width, piece_height, output_dir, workers,
+                         encoding):
+    """Hand bands of piece rows to the process pool and gather their pieces
+
+    Bands are collected in row order, so the result matches save_pieces.
+    """
+    pool = get_process_pool(workers)
+    band_rows = max(1, -(-rows // (workers * 4)))
+    
+    futures = []
+    for first_row in range(0, rows, band_rows):
+        count = min(band_rows, rows - first_row)
+        band = img.crop((0, first_row * piece_height,
+                         cols * piece_width, (first_row + count) * piece_height))
+        futures.append(pool.submit(save_pieces, band, count, cols,
+                                   piece_width, piece_height, output_dir, first_row,
+                                   encoding))
+    
+    pieces_info = []
+    for future in futures:
+        pieces_info.extend(future.result())
+    return pieces_info
+
+def save_atlas(img, rows, cols, piece_width, piece_height, output_dir, workers=1,
+               encoding=None, max_size=ATLAS_MAX_SIZE, first_row=0, first_page=0):
+    """Pack the pieces into atlas pages instead of one file per piece
+
+    The grid area already holds every piece side by side, so each page is a
+    block of whole pieces cut straight from it, at most max_size on a side.
+    img may also be a band of the grid whose top edge is piece row
+    first_row; its pages are then numbered from first_page.
+    """
+    page_cols = max(1, min(cols, max_size // piece_width))
+    page_rows = max(1, min(rows, max_size // piece_height))
+    
+    pool = get_process_pool(workers) if workers > 1 else None
+    futures = []
+    
+    pieces_info = []
+    page = first_page
+    for page_top in range(0, rows, page_rows):
+        for page_left in range(0, cols, page_cols):
+            block_rows = min(page_rows, rows - page_top)
+            block_cols = min(page_cols, cols - page_left)
+            left = page_left * piece_width
+            upper = page_top * piece_height
+            atlas = img.crop((left, upper,
+                              left + block_cols * piece_width,
+                              upper + block_rows * piece_height))
+            
+            atlas_filename = f"atlas_{page}.{file_extension(encoding)}"
+            atlas_path = os.path.join(output_dir, atlas_filename)
+            if pool is not None:
+                futures.append(pool.submit(save_image, atlas, atlas_path, encoding))
+            else:
+                save_image(atlas, atlas_path, encoding)
+            page += 1
+            
+            for row in range(first_row + page_top, first_row + page_top + block_rows):
+                for col in range(page_left, page_left + block_cols):
+                    pieces_info.append({
+                        'id': f"{row}_{col}",
+                        'row': row,
+                        'col': col,
+                        'atlas': atlas_filename,
+                        'atlasX': col * piece_width - left,
+                        'atlasY': (row - first_row) * piece_height - upper,
+                        'width': piece_width,
+                        'height': piece_height,
+                        'correctX': col * piece_width,
+                        'correctY': row * piece_height
+                    })
+    
+    for future in futures:
+        future.result()
+    
+    return pieces_info
+
+def save_vector(img, rows, cols, piece_width, piece_height, output_dir, edge_map,
+                piece_shape, encoding=None):
+    """Save the grid area as one plain image and outline each piece as a path
+
+    Nothing is masked on the server: every piece carries SVG path data for
+    its tabs and blanks and the client clips it out of the shared image. The
+    image is recorded as the pieces' single atlas page.
+    """
+    # The image is fully opaque, so drop the alpha channel from the file
+    image_filename = f"image.{file_extension(encoding)}"
+    grid = img.crop((0, 0, cols * piece_width, rows * piece_height)).convert('RGB')
+    save_image(grid, os.path.join(output_dir, image_filename), encoding)
+    
+    flat = {'top': 0, 'right': 0, 'bottom': 0, 'left': 0}
+    pieces_info = []
+    for row in range(rows):
+        for col in range(cols):
+            edges = edge_map.piece(row, col) if piece_shape == 'jigsaw' else flat
+            pieces_info.append({
+                'id': f"{row}_{col}",
+                'row': row,
+                'col': col,
+                'atlas': image_filename,
+                'atlasX': col * piece_width,
+                'atlasY': row * piece_height,
+                'width': piece_width,
+                'height': piece_height,
+                'correctX': col * piece_width,
+                'correctY': row * piece_height,
+                'path': piece_path(edges, piece_width, piece_height)
+            })
+    return pieces_info
+
+def fit_size(size, max_size):
+    """Size of an image scaled down to at most max_size pixels a side"""
+    if not max_size or max(size) <= max_size:
+        return tuple(size)
+    scale = max_size / max(size)
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+def load_image(source, max_size=None):
+    """Decode an image once into RGBA, capped at max_size pixels a side
+
+    source is a path or file-like object. Large JPEGs are decoded straight
+    at 1/2, 1/4 or 1/8 scale through draft(); resize() then reduce()s by
+    whole factors and resamples whatever is left.
+    """
+    img = Image.open(source)
+    size = fit_size(img.size, max_size)
+    if size != img.size:
+        img.draft(None, size)
+        return img.convert('RGBA').resize(size, Image.LANCZOS, reducing_gap=2.0)
+    return img.convert('RGBA')
+
+def open_bounded(source, max_pixels):
+    """Image.open, refusing images of more than max_pixels instead
+
+    Image.open measures every image against the process-wide
+    Image.MAX_IMAGE_PIXELS, which is below what a pyramid source may hold
+    and must stay in place for every other decode. This asks the same
+    format plugins directly and applies max_pixels to this image alone.
+    """
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, 'rb') as f:
+            prefix = f.read(16)
+    else:
+        source.seek(0)
+        prefix = source.read(16)
+    Image.init()
+    for format_id in Image.ID:
+        factory, accept = Image.OPEN[format_id]
+        accepted = not accept or accept(prefix)
+        # A string is Pillow's way of saying "this format, but unsupported"
+        if not accepted or isinstance(accepted, str):
+            continue
+        if not isinstance(source, (str, bytes, os.PathLike)):
+            source.seek(0)
+        try:
+            img = factory(source)
+        except (SyntaxError, IndexError, TypeError, struct.error):
+            continue
+        if img.width * img.height > max_pixels:
+            img.close()
+            raise Image.DecompressionBombError(
+                f"Image size ({img.width * img.height} pixels) exceeds limit of "
+                f"{max_pixels} pixels")
+        return img
+    raise UnidentifiedImageError(f"cannot identify image file {source!r}")
+
+def open_image(source, max_size=None, max_pixels=None):
+    """Decode an image in the mode it is stored in, capped at max_size a side
+
+    The streaming counterpart of load_image: the image is never copied to
+    RGBA as a whole, only one band at a time (see iter_bands).
+    Images that need downscaling are resampled the way load_image does it.
+    max_pixels replaces Pillow's decompression bomb limit (see open_bounded).
+    """
+    img = Image.open(source) if max_pixels is None else open_bounded(source, max_pixels)
+    size = fit_size(img.size, max_size)
+    if size != img.size:
+        img.draft(None, size)
+        # Palette and bilevel images would only resize with nearest neighbour,
+        # so they are expanded first, to the fewest bands that keep every pixel
+        if img.mode == 'P':
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        elif img.mode == '1':
+            img = img.convert('L')
+        elif img.mode == 'CMYK':
+            img = img.convert('RGB')
+        elif img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            img = img.convert('RGBA')
+        return img.resize(size, Image.LANCZOS, reducing_gap=2.0)
+    img.load()
+    return img
+
+def iter_bands(img, rows, cols, piece_width, piece_height, band_rows, piece_shape, edge_map):
+    """Yield (first_row, count, band) for every band_rows piece rows of img
+
+    Each band is cut from img in whatever mode it is in and only then made
+    RGBA and, for jigsaw pieces, masked, so there is never more than one
+    band of RGBA pixels. Tabs and blanks are drawn inside each piece's own
+    cell, so neighbouring bands need no overlap.
+    """
+    sides = edge_map.sides() if piece_shape == 'jigsaw' else None
+    edge_size = min(piece_width, piece_height) // 5
+    for first_row in range(0, rows, band_rows):
+        count = min(band_rows, rows - first_row)
+        band = img.crop((0, first_row * piece_height,
+                         cols * piece_width, (first_row + count) * piece_height)).convert('RGBA')
+        if sides is not None:
+            band_sides = {side: values[first_row:first_row + count]
+                          for side, values in sides.items()}
+            alpha = compose_alpha(band_sides, piece_width, piece_height, edge_size)
+            band.putalpha(Image.fromarray(alpha, 'L'))
+        yield first_row, count, band
+
+def save_bands(img, rows, cols, piece_width, piece_height, output_dir, output, piece_shape,
+               edge_map, workers, encoding, atlas_max_size, end_stage):
+    """The streaming half of split_image: write the pieces band by band
+
+    With workers, bands go to the process pool, at most two per worker in
+    flight, so memory stays bounded by a few bands. end_stage is called
+    after masking and after saving each band to split the timings.
+    """
+    if output == 'atlas':
+        band_rows = max(1, min(rows, atlas_max_size // piece_height))
+    else:
+        band_rows = 1
+    pool = get_process_pool(workers) if workers > 1 and output != 'atlas' else None
+    
+    pieces_info = []
+    pending = deque()
+    page = 0
+    for first_row, count, band in iter_bands(img, rows, cols, piece_width, piece_height,
+                                             band_rows, piece_shape, edge_map):
+        end_stage('mask')
+        if output == 'atlas':
+            band_info = save_atlas(band, count, cols, piece_width, piece_height, output_dir,
+                                   workers, encoding, atlas_max_size, first_row, page)
+            page += len({piece['atlas'] for piece in band_info})
+            pieces_info.extend(band_info)
+        elif pool is not None:
+            pending.append(pool.submit(save_pieces, band, count, cols, piece_width,
+                                       piece_height, output_dir, first_row, encoding))
+            if len(pending) >= workers * 2:
+                pieces_info.extend(pending.popleft().result())
+        else:
+            pieces_info.extend(save_pieces(band, count, cols, piece_width, piece_height,
+                                           output_dir, first_row, encoding))
+        del band
+        end_stage('encode')
+    while pending:
+        pieces_info.extend(pending.popleft().result())
+    end_stage('encode')
+    return pieces_info
+
+def split_image(image, rows, cols, piece_shape, output='files',
+                output_dir=PIECES_FOLDER, seed=None, workers=1, encoding=None, timings=None,
+                edge_map=None, atlas_max_size=ATLAS_MAX_SIZE, stream=False):
+    """Split an image into puzzle pieces
+
+    image is either a path or an already decoded PIL image, so callers that
+    hold the decoded upload do not have to read it back from disk.
+
+    With output='files' every piece is saved as its own image file. With
+    output='atlas' the pieces are packed into a few atlas pages instead and
+    each piece records its page and rectangle inside it. output='vector'
+    skips masking and saves the plain image with a path per piece for the
+    client to clip with (see save_vector), and atlas pages are at most
+    atlas_max_size a side. Pieces go to output_dir, static/pieces by
+    default. The same seed always yields the same edge map and shuffle;
+    pass edge_map to use one drawn beforehand.
+    
+    With more than one worker cropping and encoding run in a process pool;
+    the files written are byte-for-byte the same as a serial run. encoding
+    comes from piece_encoding() and defaults to plain PNG.
+    
+    With stream=True the image is kept in the mode it was decoded in and
+    converted, masked, cut and written one row of pieces at a time (one row
+    of atlas pages in atlas mode), so beyond the decoded image memory holds
+    a single band instead of several RGBA copies of the whole grid. The
+    pieces are the same as without streaming. Vector output saves one
+    image anyway and ignores stream.
+    
+    If a timings dict is given, the seconds spent in each stage (decode or
+    convert, edge_map, mask, encode) are added to it.
+    """
+    if timings is None:
+        timings = {}
+    stage_start = time.perf_counter()
+    
+    def end_stage(stage):
+        nonlocal stage_start
+        now = time.perf_counter()
+        timings[stage] = timings.get(stage, 0.0) + now - stage_start
+        stage_start = now
+    
+    if encoding is None:
+        encoding = piece_encoding()
+    stream = stream and output != 'vector'
+    rng = random.Random(seed)
+    
+    # Load and convert image to RGBA
+    if isinstance(image, Image.Image):
+        img = image if stream else image.convert('RGBA')
+        end_stage('convert')
+    elif stream:
+        img = open_image(image)
+        end_stage('decode')
+    else:
+        img = load_image(image)
+        end_stage('decode')
+    
+    # Calculate piece dimensions
+    piece_width = img.width // cols
+    piece_height = img.height // rows
+    
+    if edge_map is None:
+        edge_map = EdgeMap.generate(rows, cols, seed)
+    end_stage('edge_map')
+    
+    if stream:
+        pieces_info = save_bands(img, rows, cols, piece_width, piece_height, output_dir,
+                                 output, piece_shape, edge_map, workers, encoding,
+                                 atlas_max_size, end_stage)
+        rng.shuffle(pieces_info)
+        return pieces_info, piece_width, piece_height
+    
+    # Compose the alpha channel of every jigsaw piece in one batch and apply
+    # it to the grid area once, so each crop below already carries its mask
+    if piece_shape == 'jigsaw' and output != 'vector':
+        edge_size = min(piece_width, piece_height) // 5
+        alpha = compose_alpha(edge_map.sides(), piece_width, piece_height, edge_size)
+        grid_box = (0, 0, cols * piece_width, rows * piece_height)
+        img = img.crop(grid_box)
+        img.putalpha(Image.fromarray(alpha, 'L'))
+    end_stage('mask')
+    
+    # Third pass: cut and save the pieces
+    if output == 'vector':
+        pieces_info = save_vector(img, rows, cols, piece_width, piece_height, output_dir,
+                                  edge_map, piece_shape, encoding)
+    elif output == 'atlas':
+        pieces_info = save_atlas(img, rows, cols, piece_width, piece_height, output_dir,
+                                 workers, encoding, atlas_max_size)
+    elif workers > 1:
+        pieces_info = save_pieces_parallel(img, rows, cols, piece_width, piece_height,
+                                           output_dir, workers, encoding)
+    else:
+        pieces_info = save_pieces(img, rows, cols, piece_width, piece_height, output_dir,
+                                  encoding=encoding)
+    
+    # Shuffle the pieces for initial random placement
+    rng.shuffle(pieces_info)
+    end_stage('encode')
+    
+    return pieces_info, piece_width, piece_height
+
+def puzzle_payload(key, seed, pieces_info, image_size, piece_width, piece_height, rows, cols,
+                   edges=None, padding=0, levels=None):
+    """The /upload result stored with every puzzle
+
+    edges is the EdgeMap.encode() string of a jigsaw puzzle, None otherwise.
+    padding is how far piece outlines reach beyond their grid cell. levels
+    lists the piece size at every level of a pyramid puzzle.
+    """
+    # Atlas pages the client has to fetch (empty in files mode)
+    atlases = sorted({piece['atlas'] for piece in pieces_info if 'atlas' in piece})
+    
+    return {
+        'success': True,
+        'puzzleId': key,
+        'seed': seed,
+        'pieces': pieces_info,
+        'atlases': atlases,
+        'imageWidth': image_size[0],
+        'imageHeight': image_size[1],
+        'pieceWidth': piece_width,
+        'pieceHeight': piece_height,
+        'rows': rows,
+        'cols': cols,
+        'edges': edges,
+        'tabPadding': padding,
+        'levels': levels
+    }
@@ -0,0 +1,240 @@
+"""Edge compatibility of puzzle pieces and a greedy solver built on it
+
+The dissimilarity of two sides is the mean squared colour difference of
+their outermost pixel lines. Transparent pixels (the blanks of jigsaw
+pieces) are left out through per-pixel weights, which turns the whole
+pairwise matrix into a few weighted matrix products instead of a loop over
+pairs.
+"""
+import numpy as np
+
+# Pieces whose overlapping opaque pixels cover less than this share of a
+# side are not compared at all
+MIN_OVERLAP = 0.1
+
+
+def piece_strips(cells):
+    """Outermost pixel line of every side of every piece
+
+    cells is an (n, height, width, 4) RGBA uint8 array of same-sized pieces.
+    Returns side -> (n, length, 4) float32 array. Top and bottom run left to
+    right, left and right top to bottom.
+    """
+    cells = np.asarray(cells)
+    strips = {
+        'top': cells[:, 0],
+        'bottom': cells[:, -1],
+        'left': cells[:, :, 0],
+        'right': cells[:, :, -1]
+    }
+    return {side: values.astype(np.float32) for side, values in strips.items()}
+
+
+def side_features(strips):
+    """Colour values and opaque-pixel weights of one side, (n, length * 3) each"""
+    count = len(strips)
+    values = strips[..., :3].reshape(count, -1)
+    weights = np.repeat(strips[..., 3:] > 0, 3, axis=2).reshape(count, -1).astype(np.float32)
+    return values, weights
+
+
+def dissimilarity(a, wa, b, wb, block_size=1024):
+    """(n, n) weighted mean squared distance between every a[i] and b[j]
+
+    With weights, sum wa*wb*(a - b)^2 expands to three matrix products, so
+    the work is done by BLAS in row blocks of block_size, which bounds the
+    temporaries to a few block_size x n arrays.
+    """
+    count = len(a)
+    result = np.empty((count, count), dtype=np.float32)
+    b_weighted = wb * b
+    b_square = wb * b * b
+    min_overlap = MIN_OVERLAP * a.shape[1]
+    for start in range(0, count, block_size):
+        stop = min(start + block_size, count)
+        block_a, block_wa = a[start:stop], wa[start:stop]
+        overlap = block_wa @ wb.T
+        squared = ((block_wa * block_a * block_a) @ wb.T + block_wa @ b_square.T
+                   - 2 * (block_wa * block_a) @ b_weighted.T)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            block = np.maximum(squared, 0) / overlap
+        block[overlap < min_overlap] = np.inf
+        result[start:stop] = block
+    np.fill_diagonal(result, np.inf)
+    return result
+
+
+class Compatibility:
+    """Pairwise edge dissimilarity of n same-sized pieces
+
+    right[i, j] is the cost of piece j sitting directly right of piece i and
+    down[i, j] of j sitting directly below i; lower is better. Each matrix is
+    n x n float32, so 2000 pieces take 32 MB.
+    """
+
+    DIRECTIONS = {'right': (0, 1), 'down': (1, 0)}
+
+    def __init__(self, right, down):
+        self.right = right
+        self.down = down
+        self.count = len(right)
+        self._best_buddies = None
+
+    @classmethod
+    def from_strips(cls, strips, block_size=1024):
+        right = dissimilarity(*side_features(strips['right']), *side_features(strips['left']),
+                              block_size=block_size)
+        down = dissimilarity(*side_features(strips['bottom']), *side_features(strips['top']),
+                             block_size=block_size)
+        return cls(right, down)
+
+    @classmethod
+    def from_cells(cls, cells, block_size=1024):
+        return cls.from_strips(piece_strips(cells), block_size)
+
+    def matrix(self, direction):
+        return self.right if direction == 'right' else self.down
+
+    def confidence(self, direction):
+        """Cost of each pair relative to the runner-up of both pieces
+
+        A pair that is much cheaper than either piece's next best option
+        scores close to 1; ties score 0.
+        """
+        matrix = self.matrix(direction)
+        if self.count < 3:
+            return np.where(np.isfinite(matrix), 1.0, 0.0).astype(np.float32)
+        rows = np.partition(matrix, 1, axis=1)[:, 1:2]
+        cols = np.partition(matrix, 1, axis=0)[1:2, :]
+        runner_up = np.minimum(rows, cols)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = 1 - matrix / runner_up
+        return np.nan_to_num(np.clip(score, 0, 1), nan=0.0).astype(np.float32)
+
+    def best_buddies(self):
+        """Pairs that are each other's best match, most confident first
+
+        Returns a list of (confidence, i, j, direction), with j to the right
+        of or below i.
+        """
+        if self._best_buddies is not None:
+            return self._best_buddies
+        pairs = []
+        for direction in self.DIRECTIONS:
+            matrix = self.matrix(direction)
+            best_right = matrix.argmin(axis=1)
+            best_left = matrix.argmin(axis=0)
+            pieces = np.arange(self.count)
+            mutual = (best_left[best_right] == pieces) & np.isfinite(matrix[pieces, best_right])
+            confidence = self.confidence(direction)
+            for i in np.flatnonzero(mutual):
+                j = int(best_right[i])
+                pairs.append((float(confidence[i, j]), int(i), j, direction))
+        pairs.sort(reverse=True)
+        self._best_buddies = pairs
+        return pairs
+
+    def hint(self, group_of=None):
+        """Most confident best-buddy pair not yet joined, or None
+
+        group_of maps a piece index to its group; pieces in the same group
+        are already joined and never suggested.
+        """
+        for confidence, i, j, direction in self.best_buddies():
+            if group_of is None or group_of[i] != group_of[j]:
+                return confidence, i, j, direction
+        return None
+
+    def solve(self, rows, cols, candidates=4):
+        """Place every piece on a rows x cols grid
+
+        Candidate pairs, each piece's few cheapest neighbours in each
+        direction, are joined most confident first, as long as the joined
+        group still fits the grid without overlaps. Groups are then laid
+        out largest first. Returns a (rows, cols) array of piece indices.
+        """
+        count = self.count
+        assert count == rows * cols, "the grid must hold every piece"
+        candidates = min(candidates, max(1, count - 1))
+        firsts, seconds, moves, scores = [], [], [], []
+        for direction, move in self.DIRECTIONS.items():
+            matrix = self.matrix(direction)
+            confidence = self.confidence(direction)
+            nearest = np.argpartition(matrix, candidates - 1, axis=1)[:, :candidates]
+            first = np.repeat(np.arange(count), candidates)
+            second = nearest.ravel()
+            finite = np.isfinite(matrix[first, second])
+            firsts.append(first[finite])
+            seconds.append(second[finite])
+            moves.extend([move] * int(finite.sum()))
+            scores.append(confidence[first[finite], second[finite]])
+        firsts, seconds = np.concatenate(firsts), np.concatenate(seconds)
+        scores = np.concatenate(scores)
+
+        # Each group maps its pieces to positions relative to its first
+        # piece, and those positions back to pieces, and keeps its bounds
+        group_of = list(range(count))
+        members = [{i: (0, 0)} for i in range(count)]
+        cells = [{(0, 0): i} for i in range(count)]
+        bounds = [(0, 0, 0, 0) for _ in range(count)]
+        for k in np.argsort(-scores, kind='stable'):
+            i, j = int(firsts[k]), int(seconds[k])
+            gi, gj = group_of[i], group_of[j]
+            if gi == gj:
+                continue
+            move = moves[k]
+            # Always move the smaller group
+            if len(members[gi]) < len(members[gj]):
+                gi, gj, i, j = gj, gi, j, i
+                move = (-move[0], -move[1])
+            (ri, ci), (rj, cj) = members[gi][i], members[gj][j]
+            dr, dc = ri + move[0] - rj, ci + move[1] - cj
+            top, bottom, left, right = bounds[gi]
+            other = bounds[gj]
+            top, bottom = min(top, other[0] + dr), max(bottom, other[1] + dr)
+            left, right = min(left, other[2] + dc), max(right, other[3] + dc)
+            if bottom - top >= rows or right - left >= cols:
+                continue
+            if any((r + dr, c + dc) in cells[gi] for r, c in members[gj].values()):
+                continue
+            for piece, (r, c) in members[gj].items():
+                members[gi][piece] = (r + dr, c + dc)
+                cells[gi][(r + dr, c + dc)] = piece
+                group_of[piece] = gi
+            bounds[gi] = (top, bottom, left, right)
+            members[gj] = cells[gj] = None
+
+        groups = sorted((group for group in members if group), key=len, reverse=True)
+        placement = np.full((rows, cols), -1, dtype=np.int64)
+        for group in groups:
+            offset = _find_room(placement, group) if len(group) > 1 else None
+            if offset is None:
+                # No room for the group as a whole; place its pieces one by one
+                free = np.argwhere(placement < 0)
+                for (row, col), piece in zip(free, group):
+                    placement[row, col] = piece
+                continue
+            top, left = offset
+            for piece, (r, c) in group.items():
+                placement[r + top, c + left] = piece
+        return placement
+
+
+def _find_room(placement, group):
+    """Offset at which every piece of group lands on an empty cell, or None"""
+    positions = np.array(list(group.values()))
+    positions -= positions.min(axis=0)
+    height, width = positions.max(axis=0) + 1
+    rows, cols = placement.shape
+    if height > rows or width > cols:
+        return None
+    empty = placement < 0
+    fits = np.ones((rows - height + 1, cols - width + 1), dtype=bool)
+    for r, c in positions:
+        fits &= empty[r:r + rows - height + 1, c:c + cols - width + 1]
+    found = np.argwhere(fits)
+    if not len(found):
+        return None
+    top, left = found[0]
+    origin = np.array(list(group.values())).min(axis=0)
+    return top - origin[0], left - origin[1]
@@ -0,0 +1,169 @@
+// Pieces joined to their neighbours.
+//
+// Joined pieces form groups that move as one. Groups are the sets of a
+// union-find forest, candidates to join are looked up in the renderer's
+// spatial index and the puzzle is complete once a single group is left, so
+// a drop costs the same however many pieces the puzzle has.
+(function (global) {
+    'use strict';
+
+    // Disjoint sets of piece indices, union by size with path halving. Each
+    // root also keeps the list of its members so a group can be moved
+    // without scanning every piece.
+    class UnionFind {
+        constructor(count) {
+            this.parent = new Int32Array(count);
+            this.members = [];
+            for (let i = 0; i < count; i++) {
+                this.parent[i] = i;
+                this.members.push([i]);
+            }
+            this.count = count;
+        }
+
+        find(i) {
+            while (this.parent[i] !== i) {
+                this.parent[i] = this.parent[this.parent[i]];
+                i = this.parent[i];
+            }
+            return i;
+        }
+
+        // Merge the sets holding a and b and return the new root
+        union(a, b) {
+            let rootA = this.find(a);
+            let rootB = this.find(b);
+            if (rootA === rootB) {
+                return rootA;
+            }
+            if (this.members[rootA].length < this.members[rootB].length) {
+                [rootA, rootB] = [rootB, rootA];
+            }
+            this.parent[rootB] = rootA;
+            const into = this.members[rootA];
+            this.members[rootB].forEach(i => into.push(i));
+            this.members[rootB] = null;
+            this.count--;
+            return rootA;
+        }
+
+        group(i) {
+            return this.members[this.find(i)];
+        }
+    }
+
+    function adjacent(a, b) {
+        return Math.abs(a.row - b.row) + Math.abs(a.col - b.col) === 1;
+    }
+
+    class PieceGroups {
+        // Room for count pieces, handed over with add(). A piece dropped
+        // within a third of its cell size of where it belongs next to a
+        // neighbour, or on the board, is pulled into place.
+        constructor(renderer, count) {
+            this.renderer = renderer;
+            this.pieces = [];
+            this.sets = new UnionFind(count);
+            this.locked = new Uint8Array(count);
+        }
+
+        // piece is a renderer piece with row, col, correctX and correctY
+        add(piece) {
+            piece.groupIndex = this.pieces.length;
+            this.pieces.push(piece);
+        }
+
+        get count() {
+            return this.sets.count;
+        }
+
+        isComplete() {
+            return this.sets.count === 1;
+        }
+
+        // The pieces that move together with piece
+        members(piece) {
+            return this.sets.group(piece.groupIndex).map(i => this.pieces[i]);
+        }
+
+        _root(piece) {
+            return this.sets.find(piece.groupIndex);
+        }
+
+        _moveGroup(root, dx, dy) {
+            if (!dx && !dy) {
+                return;
+            }
+            this.sets.members[root].forEach(i => {
+                const piece = this.pieces[i];
+                this.renderer.moveTo(piece, piece.x + dx, piece.y + dy);
+            });
+        }
+
+        _lockGroup(root) {
+            this.locked[root] = 1;
+            this.sets.members[root].forEach(i => {
+                if (!this.pieces[i].locked) {
+                    this.renderer.lock(this.pieces[i]);
+                }
+            });
+        }
+
+        // Join the dropped piece's group to every neighbour it was laid
+        // close enough to, then pin it to the board if it is near its
+        // place there. Returns how many groups were joined and whether the
+        // group ended up locked.
+        drop(piece) {
+            const padding = piece.padding || 0;
+            const distance = (Math.min(piece.width, piece.height) - 2 * padding) / 3;
+            let joined = 0;
+
+            this.members(piece).forEach(member => {
+                const nearby = this.renderer.grid.query(member.x - distance, member.y - distance,
+                                                        member.width + 2 * distance,
+                                                        member.height + 2 * distance);
+                nearby.forEach(other => {
+                    if (!adjacent(member, other)) {
+                        return;
+                    }
+                    const root = this._root(member);
+                    const otherRoot = this._root(other);
+                    if (root === otherRoot) {
+                        return;
+                    }
+                    const dx = other.x + member.correctX - other.correctX - member.x;
+                    const dy = other.y + member.correctY - other.correctY - member.y;
+                    if (Math.abs(dx) >= distance || Math.abs(dy) >= distance) {
+                        return;
+                    }
+                    // A locked group stays put; the loose one comes to it
+                    if (this.locked[root]) {
+                        this._moveGroup(otherRoot, -dx, -dy);
+                    } else {
+                        this._moveGroup(root, dx, dy);
+                    }
+                    const locked = this.locked[root] || this.locked[otherRoot];
+                    const merged = this.sets.union(root, otherRoot);
+                    if (locked) {
+                        this._lockGroup(merged);
+                    }
+                    joined++;
+                });
+            });
+
+            const root = this._root(piece);
+            if (!this.locked[root]) {
+                const dx = piece.correctX - piece.x;
+                const dy = piece.correctY - piece.y;
+                if (Math.abs(dx) < distance && Math.abs(dy) < distance) {
+                    this._moveGroup(root, dx, dy);
+                    this._lockGroup(root);
+                }
+            }
+            return {joined: joined, locked: Boolean(this.locked[root])};
+        }
+    }
+
+    global.UnionFind = UnionFind;
+    global.PieceGroups = PieceGroups;
+})(window);
@@ -0,0 +1,366 @@
+// Draws every puzzle piece on a single canvas.
+//
+// Pieces live in a grid of buckets so hit-testing and redraws only look at
+// the pieces near a point or rectangle. Pointer moves are coalesced and
+// applied once per animation frame, and each frame repaints only the
+// rectangle that changed since the last one.
+(function (global) {
+    'use strict';
+
+    // Buckets of cellSize x cellSize CSS pixels, each holding the pieces whose
+    // box overlaps it
+    class SpatialGrid {
+        constructor(cellSize) {
+            this.cellSize = cellSize;
+            this.cells = new Map();
+        }
+
+        _keys(x, y, width, height) {
+            const size = this.cellSize;
+            const keys = [];
+            const col0 = Math.floor(x / size);
+            const col1 = Math.ceil((x + width) / size) - 1;
+            const row0 = Math.floor(y / size);
+            const row1 = Math.ceil((y + height) / size) - 1;
+            for (let row = row0; row <= row1; row++) {
+                for (let col = col0; col <= col1; col++) {
+                    keys.push(row * 100003 + col);
+                }
+            }
+            return keys;
+        }
+
+        insert(item) {
+            item._cells = this._keys(item.x, item.y, item.width, item.height);
+            item._cells.forEach(key => {
+                let cell = this.cells.get(key);
+                if (!cell) {
+                    cell = new Set();
+                    this.cells.set(key, cell);
+                }
+                cell.add(item);
+            });
+        }
+
+        remove(item) {
+            (item._cells || []).forEach(key => {
+                const cell = this.cells.get(key);
+                if (cell) {
+                    cell.delete(item);
+                    if (!cell.size) {
+                        this.cells.delete(key);
+                    }
+                }
+            });
+            item._cells = null;
+        }
+
+        update(item) {
+            const keys = this._keys(item.x, item.y, item.width, item.height);
+            const old = item._cells || [];
+            if (keys.length === old.length && keys.every((key, i) => key === old[i])) {
+                return;
+            }
+            this.remove(item);
+            this.insert(item);
+        }
+
+        // Every item overlapping the rectangle
+        query(x, y, width, height) {
+            const found = new Set();
+            this._keys(x, y, width, height).forEach(key => {
+                const cell = this.cells.get(key);
+                if (cell) {
+                    cell.forEach(item => {
+                        if (item.x < x + width && item.x + item.width > x &&
+                            item.y < y + height && item.y + item.height > y) {
+                            found.add(item);
+                        }
+                    });
+                }
+            });
+            return found;
+        }
+
+        clear() {
+            this.cells.clear();
+        }
+    }
+
+    function unionRect(a, b) {
+        if (!a) {
+            return b;
+        }
+        const x = Math.min(a.x, b.x);
+        const y = Math.min(a.y, b.y);
+        return {
+            x: x,
+            y: y,
+            width: Math.max(a.x + a.width, b.x + b.width) - x,
+            height: Math.max(a.y + a.height, b.y + b.height) - y
+        };
+    }
+
+    class PuzzleRenderer {
+        // options:
+        //   background  fill colour behind the pieces
+        //   cellSize    spatial index bucket size, about one piece box
+        //   onDrop      called with a piece when the user lets go of it
+        //   groupOf     returns the pieces that move along with a piece
+        constructor(canvas, width, height, options = {}) {
+            this.canvas = canvas;
+            this.ctx = canvas.getContext('2d');
+            this.width = width;
+            this.height = height;
+            this.background = options.background || '#eee';
+            this.onDrop = options.onDrop || null;
+            this.groupOf = options.groupOf || (piece => [piece]);
+            this.grid = new SpatialGrid(options.cellSize || 64);
+            this.pieces = [];
+            this.topZ = 0;
+            this.bottomZ = 0;
+            this.dirty = null;
+            this.dragging = null;
+            this.pointer = null;
+            this.frameId = null;
+            this.stats = {frames: 0, drawnFrames: 0, lastDrawMs: 0, lastDrawnPieces: 0};
+
+            // One pixel scratch canvas for alpha hit-tests
+            this.probe = document.createElement('canvas');
+            this.probe.width = this.probe.height = 1;
+            this.probeCtx = this.probe.getContext('2d', {willReadFrequently: true});
+
+            this._onPointerDown = this._onPointerDown.bind(this);
+            this._onPointerMove = this._onPointerMove.bind(this);
+            this._onPointerUp = this._onPointerUp.bind(this);
+            this._frame = this._frame.bind(this);
+
+            canvas.style.touchAction = 'none';
+            canvas.addEventListener('pointerdown', this._onPointerDown);
+            canvas.addEventListener('pointermove', this._onPointerMove);
+            canvas.addEventListener('pointerup', this._onPointerUp);
+            canvas.addEventListener('pointercancel', this._onPointerUp);
+
+            this.resize(width, height);
+            this.frameId = requestAnimationFrame(this._frame);
+        }
+
+        // Size the canvas for the screen's pixel density and repaint
+        resize(width, height) {
+            const ratio = window.devicePixelRatio || 1;
+            this.width = width;
+            this.height = height;
+            this.ratio = ratio;
+            this.canvas.width = Math.round(width * ratio);
+            this.canvas.height = Math.round(height * ratio);
+            this.canvas.style.width = width + 'px';
+            this.canvas.style.height = height + 'px';
+            this.invalidateAll();
+        }
+
+        // piece needs image (canvas or loaded image), x, y, width and height
+        // in CSS pixels; any other fields are kept for the caller. A piece
+        // with a border colour gets a rectangle outline.
+        addPiece(piece) {
+            piece.z = ++this.topZ;
+            piece.locked = false;
+            this.pieces.push(piece);
+            this.grid.insert(piece);
+            this.invalidatePiece(piece);
+            return piece;
+        }
+
+        clear() {
+            this.pieces = [];
+            this.grid.clear();
+            this.dragging = null;
+            this.invalidateAll();
+        }
+
+        destroy() {
+            cancelAnimationFrame(this.frameId);
+            this.canvas.removeEventListener('pointerdown', this._onPointerDown);
+            this.canvas.removeEventListener('pointermove', this._onPointerMove);
+            this.canvas.removeEventListener('pointerup', this._onPointerUp);
+            this.canvas.removeEventListener('pointercancel', this._onPointerUp);
+        }
+
+        moveTo(piece, x, y) {
+            if (piece.x === x && piece.y === y) {
+                return;
+            }
+            this.invalidatePiece(piece);
+            piece.x = x;
+            piece.y = y;
+            this.grid.update(piece);
+            this.invalidatePiece(piece);
+        }
+
+        raise(piece) {
+            piece.z = ++this.topZ;
+            this.invalidatePiece(piece);
+        }
+
+        // Locked pieces go underneath, so loose pieces can be laid over them
+        lock(piece) {
+            piece.locked = true;
+            piece.z = --this.bottomZ;
+            this.invalidatePiece(piece);
+        }
+
+        setImage(piece, image) {
+            piece.image = image;
+            this.invalidatePiece(piece);
+        }
+
+        invalidate(x, y, width, height) {
+            this.dirty = unionRect(this.dirty, {x: x, y: y, width: width, height: height});
+        }
+
+        invalidatePiece(piece) {
+            this.invalidate(piece.x, piece.y, piece.width, piece.height);
+        }
+
+        invalidateAll() {
+            this.invalidate(0, 0, this.width, this.height);
+        }
+
+        // Topmost piece with an opaque pixel at x, y, or null
+        pieceAt(x, y) {
+            const candidates = Array.from(this.grid.query(x, y, 1, 1));
+            candidates.sort((a, b) => b.z - a.z);
+            return candidates.find(piece => this._opaqueAt(piece, x, y)) || null;
+        }
+
+        _opaqueAt(piece, x, y) {
+            const image = piece.image;
+            const scaleX = (image.naturalWidth || image.width) / piece.width;
+            const scaleY = (image.naturalHeight || image.height) / piece.height;
+            this.probeCtx.clearRect(0, 0, 1, 1);
+            this.probeCtx.drawImage(image, Math.floor((x - piece.x) * scaleX),
+                                    Math.floor((y - piece.y) * scaleY), 1, 1, 0, 0, 1, 1);
+            return this.probeCtx.getImageData(0, 0, 1, 1).data[3] > 0;
+        }
+
+        _eventPoint(e) {
+            const rect = this.canvas.getBoundingClientRect();
+            return {x: e.clientX - rect.left, y: e.clientY - rect.top};
+        }
+
+        _onPointerDown(e) {
+            const point = this._eventPoint(e);
+            const piece = this.pieceAt(point.x, point.y);
+            if (!piece || piece.locked) {
+                return;
+            }
+            e.preventDefault();
+            this.canvas.setPointerCapture(e.pointerId);
+
+            // The whole group comes to the front and is kept on the board by
+            // its bounding box, measured from the grabbed piece
+            const group = this.groupOf(piece);
+            const bounds = {left: Infinity, top: Infinity, right: -Infinity, bottom: -Infinity};
+            group.forEach(member => {
+                const padding = member.padding || 0;
+                bounds.left = Math.min(bounds.left, member.x + padding - piece.x);
+                bounds.top = Math.min(bounds.top, member.y + padding - piece.y);
+                bounds.right = Math.max(bounds.right, member.x + member.width - padding - piece.x);
+                bounds.bottom = Math.max(bounds.bottom, member.y + member.height - padding - piece.y);
+                this.raise(member);
+            });
+            this.dragging = {
+                piece: piece,
+                group: group,
+                bounds: bounds,
+                offsetX: point.x - piece.x,
+                offsetY: point.y - piece.y
+            };
+            this.pointer = null;
+        }
+
+        _onPointerMove(e) {
+            if (this.dragging) {
+                // Only the latest position matters; it is applied next frame
+                this.pointer = this._eventPoint(e);
+            }
+        }
+
+        _onPointerUp(e) {
+            if (!this.dragging) {
+                return;
+            }
+            this.pointer = this._eventPoint(e);
+            this._applyDrag();
+            const piece = this.dragging.piece;
+            this.dragging = null;
+            if (this.onDrop) {
+                this.onDrop(piece);
+            }
+        }
+
+        _applyDrag() {
+            if (!this.dragging || !this.pointer) {
+                return;
+            }
+            const {piece, group, bounds} = this.dragging;
+            // Keep the group's cells inside the board; tab margins may hang
+            // over the edge
+            const x = Math.max(-bounds.left, Math.min(this.pointer.x - this.dragging.offsetX,
+                                                      this.width - bounds.right));
+            const y = Math.max(-bounds.top, Math.min(this.pointer.y - this.dragging.offsetY,
+                                                     this.height - bounds.bottom));
+            const dx = x - piece.x;
+            const dy = y - piece.y;
+            this.pointer = null;
+            group.forEach(member => this.moveTo(member, member.x + dx, member.y + dy));
+        }
+
+        _frame() {
+            this.frameId = requestAnimationFrame(this._frame);
+            this.stats.frames++;
+            this._applyDrag();
+            if (this.dirty) {
+                const started = performance.now();
+                this._draw(this.dirty);
+                this.dirty = null;
+                this.stats.drawnFrames++;
+                this.stats.lastDrawMs = performance.now() - started;
+            }
+        }
+
+        // Repaint the pieces overlapping rect, bottom to top
+        _draw(rect) {
+            const ctx = this.ctx;
+            // Whole pixels, so antialiased edges are repainted too
+            const x = Math.floor(rect.x) - 1;
+            const y = Math.floor(rect.y) - 1;
+            const width = Math.ceil(rect.x + rect.width) + 1 - x;
+            const height = Math.ceil(rect.y + rect.height) + 1 - y;
+
+            ctx.save();
+            ctx.setTransform(this.ratio, 0, 0, this.ratio, 0, 0);
+            ctx.beginPath();
+            ctx.rect(x, y, width, height);
+            ctx.clip();
+            ctx.fillStyle = this.background;
+            ctx.fillRect(x, y, width, height);
+
+            const visible = Array.from(this.grid.query(x, y, width, height));
+            visible.sort((a, b) => a.z - b.z);
+            visible.forEach(piece => {
+                ctx.drawImage(piece.image, piece.x, piece.y, piece.width, piece.height);
+                if (piece.border) {
+                    ctx.strokeStyle = piece.border;
+                    ctx.lineWidth = piece.locked ? 2 : 1;
+                    ctx.strokeRect(piece.x + ctx.lineWidth / 2, piece.y + ctx.lineWidth / 2,
+                                   piece.width - ctx.lineWidth, piece.height - ctx.lineWidth);
+                }
+            });
+            ctx.restore();
+            this.stats.lastDrawnPieces = visible.length;
+        }
+    }
+
+    global.PuzzleRenderer = PuzzleRenderer;
+    global.SpatialGrid = SpatialGrid;
+})(window);